@@ -6,25 +6,76 @@ import os
 import re
 import pandas as pd
 import PyPDF2
+import pdfplumber
 import glob
-
-def find_toc_page(pdf_path):
-    with open(pdf_path, 'rb') as pdf_file:
-        reader = PyPDF2.PdfReader(pdf_file)
-        for page_num, page in enumerate(reader.pages, start=1):
-            try:
-                text = page.extract_text()
-                if "Table of Contents" in text or "Contents" in text:
-                    return page_num
-            except Exception as e:
-                print(f"Error reading page {page_num}: {e}")
+import hashlib
+
+class DocumentSession:
+    # Parses the PDF once and caches page objects and page text for every stage
+    def __init__(self, pdf_path):
+        self.pdf_path = pdf_path
+        self._pdf_file = open(pdf_path, 'rb')
+        self.reader = PyPDF2.PdfReader(self._pdf_file)
+        self.total_pages = len(self.reader.pages)
+        self._pages = {}
+        self._page_texts = {}
+        self._plumber = None
+        self._content_hash = None
+
+    def page(self, page_index):
+        if page_index not in self._pages:
+            self._pages[page_index] = self.reader.pages[page_index]
+        return self._pages[page_index]
+
+    def page_text(self, page_index):
+        if page_index not in self._page_texts:
+            self._page_texts[page_index] = self.page(page_index).extract_text()
+        return self._page_texts[page_index]
+
+    def content_hash(self):
+        if self._content_hash is None:
+            self._content_hash = file_sha256(self.pdf_path)
+        return self._content_hash
+
+    def plumber(self):
+        # The same document opened with pdfplumber, for glyph-level extraction of page ranges
+        if self._plumber is None:
+            self._plumber = pdfplumber.open(self.pdf_path)
+        return self._plumber
+
+    def close(self):
+        self._pages.clear()
+        self._page_texts.clear()
+        if self._plumber is not None:
+            self._plumber.close()
+            self._plumber = None
+        self._pdf_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def find_toc_page(session):
+    for page_num in range(1, session.total_pages + 1):
+        try:
+            text = session.page_text(page_num - 1)
+            if "Table of Contents" in text or "Contents" in text:
+                return page_num
+        except Exception as e:
+            print(f"Error reading page {page_num}: {e}")
     return None
 
-def extract_toc_to_text(pdf_path, toc_page_num, text_file_path):
-    with open(pdf_path, 'rb') as pdf_file:
-        reader = PyPDF2.PdfReader(pdf_file)
-        toc_page = reader.pages[toc_page_num - 1]
-        toc_text = toc_page.extract_text()
+def extract_toc_to_text(session, toc_page_num, text_file_path):
+    toc_text = session.page_text(toc_page_num - 1)
 
     with open(text_file_path, 'w', encoding='utf-8') as text_file:
         text_file.write(toc_text)
@@ -50,115 +101,390 @@ def process_toc_and_save_to_excel(txt_file_path, excel_file_path):
     df.to_excel(excel_file_path, index=False)
     print(f"Structured TOC saved to {excel_file_path}")
 
-def find_offset(pdf_path):
+def find_offset(session):
     heading_pattern = re.compile(r'^\s*chapter one\s*$', re.IGNORECASE)
-    with open(pdf_path, 'rb') as pdf_file:
-        reader = PyPDF2.PdfReader(pdf_file)
-        for pdf_page_num, page in enumerate(reader.pages, start=1):
-            text = page.extract_text()
-            lines = text.splitlines()
-            for line in lines:
-                if heading_pattern.match(line.strip()):
-                    return pdf_page_num
+    for pdf_page_num in range(1, session.total_pages + 1):
+        text = session.page_text(pdf_page_num - 1)
+        lines = text.splitlines()
+        for line in lines:
+            if heading_pattern.match(line.strip()):
+                return pdf_page_num
     return None
 
 # === MAIN RUN ===
 
-pdf_path = r"C:\Users\ADITYA\Downloads\NIST.SP.800-53r5[1].pdf"
-toc_file = 'table_of_contents.txt'
-excel_file = 'structured_toc.xlsx'
-output_dir = 'extracted_sections'
-
-toc_page = find_toc_page(pdf_path)
-if toc_page:
-    extract_toc_to_text(pdf_path, toc_page, toc_file)
-    process_toc_and_save_to_excel(toc_file, excel_file)
-else:
-    print("TOC not found.")
-    exit()
-
-offset = find_offset(pdf_path)
-if offset:
-    offset -= 1
-else:
-    print("Offset not found.")
-    exit()
-
-# === SPLIT MAIN PDF INTO SECTION PDFs ===
-reader = PyPDF2.PdfReader(pdf_path)
-total_pages = len(reader.pages)
-df = pd.read_excel(excel_file, dtype={'Section': str})
-df = df.sort_values('Page Number').reset_index(drop=True)
-
-for i in range(len(df)):
-    start_section = df.iloc[i]
-    end_page_number = df.iloc[i + 1]['Page Number'] if i < len(df) - 1 else total_pages
-
-    start_page = int(start_section['Page Number']) + offset - 1
-    end_page = int(end_page_number) + offset - 1
-
-    section_id = str(start_section['Section']).strip()
-    section_name = str(start_section['Section Name']).strip().replace('/', '-')
-    section_folder = os.path.join(output_dir, f"{section_id} {section_name}")
-    os.makedirs(section_folder, exist_ok=True)
-
-    output_pdf_path = os.path.join(section_folder, f"{section_id}.pdf")
-    writer = PyPDF2.PdfWriter()
-    for page_num in range(start_page, end_page):
-        if 0 <= page_num < total_pages:
-            writer.add_page(reader.pages[page_num])
-    with open(output_pdf_path, 'wb') as f:
-        writer.write(f)
-    print(f"[+] Saved section PDF: {output_pdf_path}")
+if __name__ == "__main__":
+    pdf_path = r"C:\Users\ADITYA\Downloads\NIST.SP.800-53r5[1].pdf"
+    toc_file = 'table_of_contents.txt'
+    excel_file = 'structured_toc.xlsx'
+    output_dir = 'extracted_sections'
+    stream_pages = True  # group and match one page at a time instead of loading a whole section
+    extraction_workers = 1  # >1 extracts glyphs on a process pool, merged back in page order
+    section_workers = 1  # >1 processes section folders concurrently (glyph extraction then runs in-process)
+    write_section_pdfs = False  # also save each section as its own PDF (sections are read from the main PDF either way)
+    write_subheading_excel = False  # also export each section's subheading table as <id>_subheadings.xlsx
+    chunk_output = "files"  # "files": txt_chunks/ + json_chunks/ per section; "jsonl": one chunks.jsonl per section
+    structuring = "regex_first"  # "regex_first": deterministic parser, LLM only for chunks failing validation; "llm": every chunk
+    llm_protocol = "verbatim"  # "boundaries": the model only returns line ranges per section and the text is sliced locally
+    llm_max_ctx = 8192  # largest num_ctx to request; each call gets the smallest size that fits, longer chunks are split and merged
+    llm_concurrency = 4  # LLM requests in flight at once; Ollama serves up to OLLAMA_NUM_PARALLEL of them in parallel
+    llm_retries = 2  # extra attempts per chunk when a request fails
+    llm_cache_dir = '.llm_cache'  # responses keyed by model, options, prompt and chunk text; None disables it
+    llm_cache_max_bytes = 256 * 1024 * 1024  # least recently used responses are evicted past this size
+    corpus_db_path = None  # e.g. os.path.join("outputs", "corpus.sqlite"): also store sections, chunks and policies in SQLite with FTS5 search
+    glyph_cache_dir = '.glyph_cache'  # per-page glyph/line cache keyed by PDF content hash; None disables it
+    incremental = True  # skip sections whose pages and section_config match extracted_sections/manifest.json
+
+    session = DocumentSession(pdf_path)
+
+    toc_page = find_toc_page(session)
+    if toc_page:
+        extract_toc_to_text(session, toc_page, toc_file)
+        process_toc_and_save_to_excel(toc_file, excel_file)
+    else:
+        print("TOC not found.")
+        exit()
+
+    offset = find_offset(session)
+    if offset:
+        offset -= 1
+    else:
+        print("Offset not found.")
+        exit()
+
+    # === SPLIT MAIN PDF INTO SECTION PAGE RANGES ===
+    total_pages = session.total_pages
+    df = pd.read_excel(excel_file, dtype={'Section': str})
+    df = df.sort_values('Page Number').reset_index(drop=True)
+
+    sections = {}
+    for i in range(len(df)):
+        start_section = df.iloc[i]
+        end_page_number = df.iloc[i + 1]['Page Number'] if i < len(df) - 1 else total_pages
+
+        start_page = int(start_section['Page Number']) + offset - 1
+        end_page = int(end_page_number) + offset - 1
+
+        section_id = str(start_section['Section']).strip()
+        section_name = str(start_section['Section Name']).strip().replace('/', '-')
+        section_folder = os.path.join(output_dir, f"{section_id} {section_name}")
+        os.makedirs(section_folder, exist_ok=True)
+
+        page_numbers = [page_num + 1 for page_num in range(start_page, end_page) if 0 <= page_num < total_pages]
+        sections[section_folder] = {
+            "folder_path": section_folder,
+            "source_pdf": pdf_path,
+            "page_numbers": page_numbers,
+        }
+        print(f"[+] Section {section_id}: pages {start_page + 1}-{end_page} of {pdf_path}")
+
+        if write_section_pdfs:
+            output_pdf_path = os.path.join(section_folder, f"{section_id}.pdf")
+            writer = PyPDF2.PdfWriter()
+            for page_num in page_numbers:
+                writer.add_page(session.page(page_num - 1))
+            with open(output_pdf_path, 'wb') as f:
+                writer.write(f)
+            print(f"[+] Saved section PDF: {output_pdf_path}")
 
 # === CONTINUES in next message with final_sub_all logic and subheading integration ===
 # === START: final_sub_all.py logic (slightly adapted for loop) ===
 
 import pdfplumber
 import pandas as pd
-from pypdf import PdfReader
+import numpy as np
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 import re
 import json
 import os
+import hashlib
+import traceback
+import shutil
+from bisect import bisect_left
+from collections import deque
+
+class CharStore:
+    # Columnar glyph storage: one NumPy array per attribute instead of a dict per character.
+    # Font names are interned into `fonts` and glyph texts share one string buffer,
+    # glyph i spanning text[text_offsets[i]:text_offsets[i + 1]].
+    def __init__(self, page, x, y, size, font_ids, fonts, text, text_offsets):
+        self.page = page
+        self.x = x
+        self.y = y
+        self.size = size
+        self.font_ids = font_ids
+        self.fonts = fonts
+        self.text = text
+        self.text_offsets = text_offsets
+        self._font_table = None
+
+    def __len__(self):
+        return len(self.page)
+
+    def font_table(self):
+        if self._font_table is None:
+            self._font_table = FontTable(self.fonts)
+        return self._font_table
+
+    def span_text(self, start, end):
+        return self.text[self.text_offsets[start]:self.text_offsets[end]]
+
+    def char_texts(self, start, end):
+        offsets = self.text_offsets[start:end + 1].tolist()
+        return [self.text[offsets[k]:offsets[k + 1]] for k in range(end - start)]
+
+    def single_code_points(self):
+        return len(self.text) == len(self) and bool(np.all(np.diff(self.text_offsets) == 1))
+
+    def caps_mask(self):
+        # Per glyph: text.isalpha() and text.isupper(), evaluated once per distinct glyph text
+        if self.single_code_points():
+            codes = np.frombuffer(self.text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+            distinct, inverse = np.unique(codes, return_inverse=True)
+            flags = np.array([chr(c).isalpha() and chr(c).isupper() for c in distinct.tolist()], dtype=bool)
+            return flags[inverse.reshape(-1)]
+        flags = {}
+        parts = self.char_texts(0, len(self))
+        for t in parts:
+            if t not in flags:
+                flags[t] = t.isalpha() and t.isupper()
+        return np.fromiter((flags[t] for t in parts), dtype=bool, count=len(parts))
+
+    def take(self, order):
+        if self.single_code_points():
+            # Every glyph is one code point, so the buffer can be permuted as a UTF-32 array
+            codes = np.frombuffer(self.text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+            text = codes[order].tobytes().decode('utf-32-le', 'surrogatepass')
+            text_offsets = np.arange(len(order) + 1, dtype=np.int64)
+        else:
+            parts = self.char_texts(0, len(self))
+            parts = [parts[i] for i in order.tolist()]
+            text = "".join(parts)
+            text_offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+            np.cumsum([len(t) for t in parts], out=text_offsets[1:])
+        return CharStore(
+            self.page[order], self.x[order], self.y[order], self.size[order],
+            self.font_ids[order], self.fonts, text, text_offsets,
+        )
+
+class CharStoreBuilder:
+    def __init__(self):
+        self.page = array('i')
+        self.x = array('d')
+        self.y = array('d')
+        self.size = array('d')
+        self.font_ids = array('i')
+        self.fonts = []
+        self.font_index = {}
+        self.text_parts = []
+        self.text_lengths = array('q')
+
+    def add_char(self, page_num, char):
+        fontname = char.get("fontname", "")
+        font_id = self.font_index.get(fontname)
+        if font_id is None:
+            font_id = self.font_index[fontname] = len(self.fonts)
+            self.fonts.append(fontname)
+        self.page.append(page_num)
+        self.x.append(char.get("x0", 0))
+        self.y.append(char.get("top", 0))
+        self.size.append(char.get("size", 0))
+        self.font_ids.append(font_id)
+        self.text_parts.append(char["text"])
+        self.text_lengths.append(len(char["text"]))
+
+    def build(self):
+        text_offsets = np.zeros(len(self.text_lengths) + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(self.text_lengths, dtype=np.int64), out=text_offsets[1:])
+        return CharStore(
+            np.array(self.page, dtype=np.int32),
+            np.array(self.x, dtype=np.float64),
+            np.array(self.y, dtype=np.float64),
+            np.array(self.size, dtype=np.float64),
+            np.array(self.font_ids, dtype=np.int32),
+            self.fonts,
+            "".join(self.text_parts),
+            text_offsets,
+        )
+
+def concat_char_stores(stores):
+    # Merges stores given in page order into one, re-interning their font tables
+    fonts = []
+    font_index = {}
+    font_ids = []
+    text_offsets = [np.zeros(1, dtype=np.int64)]
+    text_base = 0
+    for store in stores:
+        remap = []
+        for fontname in store.fonts:
+            if fontname not in font_index:
+                font_index[fontname] = len(fonts)
+                fonts.append(fontname)
+            remap.append(font_index[fontname])
+        font_ids.append(np.array(remap, dtype=np.int32)[store.font_ids])
+        text_offsets.append(store.text_offsets[1:] + text_base)
+        text_base += len(store.text)
+    if not stores:
+        return CharStoreBuilder().build()
+    return CharStore(
+        np.concatenate([store.page for store in stores]),
+        np.concatenate([store.x for store in stores]),
+        np.concatenate([store.y for store in stores]),
+        np.concatenate([store.size for store in stores]),
+        np.concatenate(font_ids),
+        fonts,
+        "".join(store.text for store in stores),
+        np.concatenate(text_offsets),
+    )
 
-def extract_text_with_styles(pdf_path):
-    with pdfplumber.open(pdf_path) as pdf:
-        text_data = []
-        for page_num, page in enumerate(pdf.pages, start=1):
-            for char in page.chars:
-                text_data.append({
-                    "text": char["text"],
-                    "page": page_num,
-                    "fontname": char.get("fontname", ""),
-                    "fontsize": char.get("size", 0),
-                    "x": char.get("x0", 0),
-                    "y": char.get("top", 0),
-                })
-        return text_data
+def page_char_store(page, page_num):
+    builder = CharStoreBuilder()
+    for char in page.chars:
+        builder.add_char(page_num, char)
+    page.close()
+    return builder.build()
+
+GLYPH_CACHE_VERSION = 1
+
+class GlyphCache:
+    # On-disk cache of each page's position-sorted glyph columns and grouped lines, keyed by
+    # the PDF's content hash and page number, so an unchanged PDF skips pdfplumber entirely
+    def __init__(self, cache_dir, pdf_hash):
+        self.page_dir = os.path.join(cache_dir, f"{pdf_hash}_v{GLYPH_CACHE_VERSION}")
+        os.makedirs(self.page_dir, exist_ok=True)
+
+    def path(self, page_num, line_tolerance):
+        return os.path.join(self.page_dir, f"page_{page_num:05d}_tol{line_tolerance}.npz")
+
+    def contains(self, page_num, line_tolerance):
+        return os.path.exists(self.path(page_num, line_tolerance))
+
+    def load(self, page_num, line_tolerance, label):
+        path = self.path(page_num, line_tolerance)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            char_count = len(data["x"])
+            text_data = CharStore(
+                np.full(char_count, label, dtype=np.int32),
+                data["x"],
+                data["y"],
+                data["size"],
+                data["font_ids"],
+                data["fonts"].tolist(),
+                data["text"].tobytes().decode('utf-8', 'surrogatepass'),
+                data["text_offsets"],
+            )
+            line_starts = data["line_starts"]
+        line_ends = np.append(line_starts[1:], char_count)
+        return text_data, list(zip(line_starts.tolist(), line_ends.tolist()))
+
+    def save(self, page_num, line_tolerance, text_data, grouped_lines):
+        path = self.path(page_num, line_tolerance)
+        tmp_path = f"{path[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            x=text_data.x,
+            y=text_data.y,
+            size=text_data.size,
+            font_ids=text_data.font_ids,
+            fonts=np.array(text_data.fonts, dtype=str),
+            text=np.frombuffer(text_data.text.encode('utf-8', 'surrogatepass'), dtype=np.uint8),
+            text_offsets=text_data.text_offsets,
+            line_starts=np.array([start for start, _ in grouped_lines], dtype=np.int64),
+        )
+        os.replace(tmp_path, path)
+
+def load_page_lines(pdf, page_num, label, line_tolerance=2, cache=None):
+    # Sorted CharStore and grouped lines of one page (1-based page_num of the open pdfplumber
+    # document), with its page column set to `label`; read through the glyph cache when given
+    if cache is not None:
+        cached = cache.load(page_num, line_tolerance, label)
+        if cached is not None:
+            return cached
+    page_store = page_char_store(pdf.pages[page_num - 1], label)
+    text_data, grouped_lines = group_text_by_position(page_store, line_tolerance)
+    if cache is not None:
+        cache.save(page_num, line_tolerance, text_data, grouped_lines)
+    return text_data, grouped_lines
+
+def extract_page_batch(pdf_path, page_numbers, first_label=1, line_tolerance=2, cache=None):
+    # Process-pool task: each worker opens the PDF on its own, unless every page is cached
+    if cache is not None and all(cache.contains(page_num, line_tolerance) for page_num in page_numbers):
+        pdf = None
+    else:
+        pdf = pdfplumber.open(pdf_path)
+    try:
+        return [
+            load_page_lines(pdf, page_num, label, line_tolerance, cache)
+            for label, page_num in enumerate(page_numbers, start=first_label)
+        ]
+    finally:
+        if pdf is not None:
+            pdf.close()
+
+def iter_page_lines(pdf_path, line_tolerance=2, pool=None, page_numbers=None, pdf=None, cache=None,
+                    pages_per_task=4):
+    # Yields (page_num, text_data, grouped_lines) for each page in page_numbers (1-based pages
+    # of pdf_path, default all), one page at a time so memory stays per-page. Pages are
+    # labelled 1, 2, ... in order so page numbers stay relative to the section being read.
+    # Closing each pdfplumber page releases its cached objects. An already open pdfplumber
+    # document can be passed as `pdf`; with a process pool, page batches are extracted by
+    # the workers and pool.map hands the results back in submission (page) order.
+    if pool is None:
+        if pdf is None:
+            with pdfplumber.open(pdf_path) as pdf:
+                yield from iter_page_lines(pdf_path, line_tolerance, page_numbers=page_numbers, pdf=pdf, cache=cache)
+            return
+        if page_numbers is None:
+            page_numbers = range(1, len(pdf.pages) + 1)
+        for label, page_num in enumerate(page_numbers, start=1):
+            text_data, grouped_lines = load_page_lines(pdf, page_num, label, line_tolerance, cache)
+            yield label, text_data, grouped_lines
+        return
+
+    if page_numbers is None:
+        with pdfplumber.open(pdf_path) as pdf:
+            page_numbers = range(1, len(pdf.pages) + 1)
+    page_numbers = list(page_numbers)
+    batch_starts = range(0, len(page_numbers), pages_per_task)
+    batches = [page_numbers[start:start + pages_per_task] for start in batch_starts]
+    first_labels = [start + 1 for start in batch_starts]
+    page_batches = pool.map(
+        extract_page_batch,
+        [pdf_path] * len(batches),
+        batches,
+        first_labels,
+        [line_tolerance] * len(batches),
+        [cache] * len(batches),
+    )
+    label = 0
+    for page_lines in page_batches:
+        for text_data, grouped_lines in page_lines:
+            label += 1
+            yield label, text_data, grouped_lines
 
-def group_text_by_position(text_data, line_tolerance=2):
-    grouped_lines = []
-    current_line = []
+def extract_text_with_styles(pdf_path, pool=None, page_numbers=None, pdf=None, cache=None):
+    # Whole-range store; pages come back position-sorted, which grouping keeps as is
+    pages = iter_page_lines(pdf_path, pool=pool, page_numbers=page_numbers, pdf=pdf, cache=cache)
+    return concat_char_stores([text_data for _, text_data, _ in pages])
 
-    for char_data in sorted(text_data, key=lambda x: (x["page"], x["y"], x["x"])):
-        if not current_line:
-            current_line.append(char_data)
-        else:
-            last_char = current_line[-1]
-            same_line = (
-                abs(char_data["y"] - last_char["y"]) <= line_tolerance and
-                char_data["page"] == last_char["page"]
-            )
-            if same_line:
-                current_line.append(char_data)
-            else:
-                grouped_lines.append(current_line)
-                current_line = [char_data]
+def group_text_by_position(text_data, line_tolerance=2):
+    # Returns the store sorted by (page, y, x) and each line as a (start, end) range into it.
+    # A new line starts wherever the page changes or y jumps by more than line_tolerance
+    # from the previous glyph, exactly like the old glyph-by-glyph walk.
+    order = np.lexsort((text_data.x, text_data.y, text_data.page))
+    text_data = text_data.take(order)
+    if not len(text_data):
+        return text_data, []
 
-    if current_line:
-        grouped_lines.append(current_line)
+    breaks = (np.abs(np.diff(text_data.y)) > line_tolerance) | (np.diff(text_data.page) != 0)
+    line_starts = np.concatenate(([0], np.flatnonzero(breaks) + 1))
+    line_ends = np.append(line_starts[1:], len(text_data))
+    grouped_lines = list(zip(line_starts.tolist(), line_ends.tolist()))
 
-    return grouped_lines
+    return text_data, grouped_lines
 
 def is_all_caps(text):
     filtered = ''.join(c for c in text if c.isalpha())
@@ -167,73 +493,127 @@ def is_all_caps(text):
 def is_bold(fontname):
     return "Bold" in fontname or "bold" in fontname
 
-def extract_all_subheadings_with_style(lines, fontname, fontsize, all_caps, bold):
-    matched_subheadings = []
-    for line in lines:
-        text = "".join(char["text"] for char in line).strip()
-        if not text:
-            continue
-        total_chars = len(line)
-        total_bold_chars = sum(1 for char in line if is_bold(char.get("fontname", "")))
-        overall_line_bold = total_bold_chars / total_chars >= 0.7
-        font_counts = {}
-        for char in line:
-            fnt = char.get("fontname", "")
-            font_counts[fnt] = font_counts.get(fnt, 0) + 1
-        majority_fontname = max(font_counts, key=font_counts.get)
-
-        char_style_matches = []
-        for char in line:
-            c_fontname = char.get("fontname", "")
-            c_fontsize = char.get("fontsize", char.get("size", 0))
-            c_text = char["text"]
-            c_all_caps = c_text.isalpha() and c_text.isupper()
-            c_bold = is_bold(c_fontname)
-            fontname_match = (c_fontname == fontname)
-            fontsize_match = abs(c_fontsize - fontsize) < 1
-            all_caps_match = (c_all_caps == all_caps)
-            bold_match = (overall_line_bold == bold)
-            is_char_matching = fontname_match and fontsize_match and all_caps_match and bold_match
-            char_style_matches.append(is_char_matching)
-
-        start_noise = 0
-        for match in char_style_matches:
-            if not match:
-                start_noise += 1
-            else:
-                break
-
-        end_noise = 0
-        for match in reversed(char_style_matches):
-            if not match:
-                end_noise += 1
-            else:
-                break
+def is_italic(fontname):
+    lowered = fontname.lower()
+    return "italic" in lowered or "oblique" in lowered
+
+def font_family(fontname):
+    # "ABCDEF+Arial-BoldMT" -> "Arial": drops the subset prefix and the style suffix
+    return re.split(r"[-,]", re.sub(r"^[A-Z]{6}\+", "", fontname))[0]
+
+class FontTable:
+    # Attributes of a store's interned fonts, indexed by font id, so per-glyph checks
+    # become array lookups instead of string scans
+    def __init__(self, fonts):
+        self.bold = np.array([is_bold(f) for f in fonts], dtype=bool)
+        self.italic = np.array([is_italic(f) for f in fonts], dtype=bool)
+        self.family = [font_family(f) for f in fonts]
+        family_index = {}
+        self.family_ids = np.array(
+            [family_index.setdefault(family, len(family_index)) for family in self.family], dtype=np.int32
+        )
+
+def majority_fonts(text_data, lengths):
+    # Most frequent font id of each line (the lines partition the store in order); ties go
+    # to the font that appears first in the line
+    if not len(lengths):
+        return np.zeros(0, dtype=np.int64)
+    n_fonts = len(text_data.fonts)
+    line_ids = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+    keys = line_ids * n_fonts + text_data.font_ids
+    distinct, first_seen, counts = np.unique(keys, return_index=True, return_counts=True)
+    key_lines = distinct // n_fonts
+    order = np.lexsort((first_seen, -counts, key_lines))
+    best = order[np.concatenate(([True], key_lines[order][1:] != key_lines[order][:-1]))]
+    return distinct[best] % n_fonts
+
+class LineTable:
+    # Per-line features computed once, in line order: stripped and lowercase text,
+    # majority font (id and name), bold ratio, all-caps flag, first-glyph size, page and y.
+    # The glyph store and each line's (start, end) range stay available for glyph-level checks;
+    # the lines partition the store in order, as group_text_by_position produces them.
+    def __init__(self, text_data, lines):
+        self.text_data = text_data
+        self.start = [start for start, _ in lines]
+        self.end = [end for _, end in lines]
+        self.text = [text_data.span_text(start, end).strip() for start, end in lines]
+        self.lower = [text.lower() for text in self.text]
+        self.all_caps = [is_all_caps(text) for text in self.text]
+        first_glyphs = np.array(self.start, dtype=np.int64)
+        lengths = np.array(self.end, dtype=np.int64) - first_glyphs
+        bold_glyphs = text_data.font_table().bold[text_data.font_ids].astype(np.int64)
+        bold_counts = np.add.reduceat(bold_glyphs, first_glyphs) if len(lines) else lengths
+        self.font_ids = majority_fonts(text_data, lengths).tolist()
+        self.font = [text_data.fonts[f] for f in self.font_ids]
+        self.bold_ratio = (bold_counts / lengths).tolist()
+        self.size = text_data.size[first_glyphs].tolist()
+        self.page = text_data.page[first_glyphs].tolist()
+        self.y = text_data.y[first_glyphs].tolist()
+
+    def __len__(self):
+        return len(self.text)
+
+def style_noise(line_table, fontname, fontsize, all_caps, bold):
+    # Glyph-level style match for every line at once. A glyph matches when its font name,
+    # size (within 1), caps state and its line's boldness all match the subheading style.
+    # Returns the per-line counts of non-matching glyphs before the first and after the
+    # last matching glyph (the whole line length on both sides when nothing matches).
+    text_data = line_table.text_data
+    starts = np.array(line_table.start, dtype=np.int64)
+    ends = np.array(line_table.end, dtype=np.int64)
+    lengths = ends - starts
+
+    font_match = np.array([f == fontname for f in text_data.fonts], dtype=bool)[text_data.font_ids]
+    size_match = np.abs(text_data.size - fontsize) < 1
+    caps_match = text_data.caps_mask() == all_caps
+    line_bold = np.array(line_table.bold_ratio) >= 0.7
+    bold_match = np.repeat(line_bold == bold, lengths)
+    matches = font_match & size_match & caps_match & bold_match
+
+    positions = np.arange(len(text_data), dtype=np.int64)
+    first_match = np.minimum.reduceat(np.where(matches, positions, len(text_data)), starts)
+    last_match = np.maximum.reduceat(np.where(matches, positions, -1), starts)
+    start_noise = np.where(first_match < ends, first_match - starts, lengths)
+    end_noise = np.where(last_match >= starts, ends - 1 - last_match, lengths)
+    return start_noise, end_noise
+
+def extract_all_subheadings_with_style(line_table, fontname, fontsize, all_caps, bold):
+    if not len(line_table):
+        return []
+    text_data = line_table.text_data
+    start_noise, end_noise = style_noise(line_table, fontname, fontsize, all_caps, bold)
+    lengths = np.array(line_table.end, dtype=np.int64) - np.array(line_table.start, dtype=np.int64)
+    within_noise = (start_noise + end_noise) / lengths <= 0.3
 
-        if (start_noise + end_noise) / total_chars > 0.3:
+    matched_subheadings = []
+    for i in np.flatnonzero(within_noise).tolist():
+        if not line_table.text[i]:
             continue
+        start, end = line_table.start[i], line_table.end[i]
+        total_chars = end - start
+        char_texts = text_data.char_texts(start, end)
 
-        start_idx = start_noise
-        end_idx = total_chars - 1 - end_noise
+        start_idx = int(start_noise[i])
+        end_idx = total_chars - 1 - int(end_noise[i])
 
-        while start_idx <= end_idx and line[start_idx]["text"].isspace():
+        while start_idx <= end_idx and char_texts[start_idx].isspace():
             start_idx += 1
-        while end_idx >= start_idx and line[end_idx]["text"].isspace():
+        while end_idx >= start_idx and char_texts[end_idx].isspace():
             end_idx -= 1
 
-        cleaned_text = "".join(char["text"] for char in line[start_idx:end_idx+1]).strip()
+        cleaned_text = "".join(char_texts[start_idx:end_idx+1]).strip()
 
         if all_caps and not is_all_caps(cleaned_text):
             continue
 
         matched_subheadings.append({
             "text": cleaned_text,
-            "page": line[0]["page"],
-            "fontname": majority_fontname,
+            "page": line_table.page[i],
+            "fontname": line_table.font[i],
             "fontsize": fontsize,
             "all_caps": all_caps,
             "bold": bold,
-            "y": line[0]["y"],
+            "y": line_table.y[i],
         })
     return matched_subheadings
 
@@ -254,59 +634,48 @@ def merge_successive_subheadings(subheadings, y_tolerance=25):
     merged.append(prev)
     return merged
 
-def detect_first_subheading(lines):
-    main_heading = None
-    found_main_heading = False
-    main_heading_page = None
-    main_heading_y = None
-    candidates = []
-    for line in lines:
-        text = "".join(char["text"] for char in line).strip()
+def scan_heading_candidates(line_table, state):
+    # Finds the main heading and collects the lines below it on the same page.
+    # `state` carries main_heading/candidates across calls so pages can be fed one at a time.
+    for i, text in enumerate(line_table.text):
         if not text:
             continue
-        font_counts = {}
-        for char in line:
-            fnt = char.get("fontname", "")
-            font_counts[fnt] = font_counts.get(fnt, 0) + 1
-        majority_fontname = max(font_counts, key=font_counts.get)
-        fontname = majority_fontname
-        fontsize = line[0]["fontsize"]
-        page = line[0]["page"]
-        y = line[0]["y"]
-
-        if not found_main_heading:
+        fontname = line_table.font[i]
+        fontsize = line_table.size[i]
+        page = line_table.page[i]
+        y = line_table.y[i]
+
+        main_heading = state["main_heading"]
+        if main_heading is None:
             if len(text.split()) <= 10 and fontsize > 10:
-                main_heading = {
+                state["main_heading"] = {
                     "text": text,
                     "page": page,
                     "fontname": fontname,
                     "fontsize": fontsize,
                     "y": y,
                 }
-                main_heading_page = page
-                main_heading_y = y
-                found_main_heading = True
         else:
-            if page == main_heading_page and y > main_heading_y + 0.5:
-                total_chars = len(line)
-                total_bold_chars = sum(1 for char in line if is_bold(char.get("fontname", "")))
-                line_bold = (total_bold_chars / total_chars) >= 0.7
-                candidates.append({
+            if page == main_heading["page"] and y > main_heading["y"] + 0.5:
+                state["candidates"].append({
                     "text": text,
                     "page": page,
                     "fontname": fontname,
                     "fontsize": fontsize,
                     "y": y,
-                    "all_caps": is_all_caps(text),
-                    "bold": line_bold,
+                    "all_caps": line_table.all_caps[i],
+                    "bold": line_table.bold_ratio[i] >= 0.7,
                 })
 
+def pick_first_subheading(state):
+    candidates = state["candidates"]
     if not candidates:
-        return []
+        return None
 
+    main_heading = state["main_heading"]
     filtered_candidates = [c for c in candidates if c["y"] > main_heading["y"] + 0.5]
     if not filtered_candidates:
-        return []
+        return None
 
     filtered_candidates.sort(key=lambda c: (
         -c["fontsize"],
@@ -314,214 +683,529 @@ def detect_first_subheading(lines):
         -int(c["bold"]),
     ))
 
-    first_subheading = filtered_candidates[0]
+    return filtered_candidates[0]
 
-    matched_subheadings = extract_all_subheadings_with_style(
-        lines,
+def match_first_subheading_style(line_table, first_subheading):
+    return extract_all_subheadings_with_style(
+        line_table,
         first_subheading["fontname"],
         first_subheading["fontsize"],
         first_subheading["all_caps"],
         first_subheading["bold"],
     )
 
+def detect_first_subheading(line_table):
+    state = {"main_heading": None, "candidates": []}
+    scan_heading_candidates(line_table, state)
+    first_subheading = pick_first_subheading(state)
+    if first_subheading is None:
+        return []
+
+    matched_subheadings = match_first_subheading_style(line_table, first_subheading)
+
     return merge_successive_subheadings(matched_subheadings)
 
-def complete_excel_sheet(pdf_path, excel_path, line_number_map):
-    df = pd.read_excel(excel_path)
-    reader = PdfReader(pdf_path)
-    lines_by_page = {}
-    for entry in line_number_map:
-        lines_by_page.setdefault(entry["page"], []).append(entry)
-
-    for idx, row in df.iterrows():
-        subheading_text = row["Subheading"]
-        page_no = row["Page No"]
-        if page_no not in lines_by_page:
-            continue
-        page_lines = lines_by_page[page_no]
+def build_line_number_map(line_table):
+    page_line_counter = {}
+    line_number_map = []
+    for i, page in enumerate(line_table.page):
+        page_line_counter[page] = page_line_counter.get(page, 0) + 1
+        line_number_map.append({
+            "text": line_table.text[i],
+            "lower": line_table.lower[i],
+            "page": page,
+            "y": line_table.y[i],
+            "line_on_page": page_line_counter[page]
+        })
+    return line_number_map
+
+def detect_subheadings_from_pages(page_stream):
+    # Streaming counterpart of detect_first_subheading. Only the pages up to the main
+    # heading page are held until the subheading style is known; every later page is
+    # matched and dropped as soon as it arrives. Returns (subheadings, line_number_map).
+    state = {"main_heading": None, "candidates": []}
+    first_subheading = None
+    pending_pages = []
+    matched_subheadings = []
+    line_number_map = []
+
+    for page_num, text_data, grouped_lines in page_stream:
+        line_table = LineTable(text_data, grouped_lines)
+        line_number_map.extend(build_line_number_map(line_table))
+
+        if first_subheading is None:
+            scan_heading_candidates(line_table, state)
+            pending_pages.append(line_table)
+            if state["main_heading"] is None:
+                continue
+            first_subheading = pick_first_subheading(state)
+            if first_subheading is None:
+                return [], line_number_map
+            for pending_table in pending_pages:
+                matched_subheadings.extend(match_first_subheading_style(pending_table, first_subheading))
+            pending_pages = []
+        else:
+            matched_subheadings.extend(match_first_subheading_style(line_table, first_subheading))
+
+    return merge_successive_subheadings(matched_subheadings), line_number_map
+
+def heading_snippet(subheading_text):
+    return subheading_text[:10].strip().lower()
+
+class HeadingMatcher:
+    # Aho-Corasick automaton over a section's heading snippets, so one pass over the
+    # lines finds every heading instead of one search per heading per line
+    def __init__(self, keys):
+        self.keys = list(dict.fromkeys(keys))
+        self.always = [key_id for key_id, key in enumerate(self.keys) if not key]
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for key_id, key in enumerate(self.keys):
+            if not key:
+                continue
+            node = 0
+            for ch in key:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = self.goto[node][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append(key_id)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fail = self.fail[node]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[nxt] = self.goto[fail].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find(self, text):
+        # Ids of the keys occurring anywhere in `text`
+        found = set(self.always)
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+    def scan(self, lines):
+        # {key: [line index, ...]} in line order for every line containing the key;
+        # None lines are skipped
+        hits = {key: [] for key in self.keys}
+        for idx, line in enumerate(lines):
+            if line is None:
+                continue
+            for key_id in self.find(line):
+                hits[self.keys[key_id]].append(idx)
+        return hits
+
+def build_subheading_table(subheadings, line_number_map):
+    # One row per subheading; Line on Page is the first line on the heading's page
+    # containing its snippet (None when there is none)
+    snippets = [heading_snippet(sh["text"]) for sh in subheadings]
+    hits = HeadingMatcher(snippets).scan(entry["lower"] for entry in line_number_map)
+
+    subheading_table = []
+    for sh, snippet in zip(subheadings, snippets):
         found_line_number = None
-        subhead_snippet = re.escape(subheading_text[:10].strip().lower())
-        for line_entry in page_lines:
-            line_text = "".join(char["text"] for char in line_entry["line"]).strip().lower()
-            if re.search(subhead_snippet, line_text):
-                found_line_number = line_entry["line_on_page"]
+        for line_idx in hits[snippet]:
+            if line_number_map[line_idx]["page"] == sh["page"]:
+                found_line_number = line_number_map[line_idx]["line_on_page"]
                 break
-        df.at[idx, "Line on Page"] = found_line_number if found_line_number else float('nan')
-
-    df.to_excel(excel_path, index=False)
-
-def extract_last_subheading_to_section_end(last_subheading, line_number_map, output_path, json_dir):
-    start_regex = re.escape(last_subheading['text'][:10].strip().lower())
-    start_found = False
-    extracted_lines = []
-    for entry in line_number_map:
-        line_text = "".join(char["text"] for char in entry["line"]).strip()
-        line_text_lower = line_text.lower()
-        if len(line_text) < 4:
-            continue
-        if not start_found:
-            if re.search(start_regex, line_text_lower):
-                start_found = True
-                extracted_lines.append(line_text)
+        subheading_table.append({
+            "Subheading": sh["text"],
+            "Page No": sh["page"],
+            "Line on Page": found_line_number,
+        })
+    return subheading_table
+
+def next_hit(hits, start):
+    # First line index in `hits` at or after `start`
+    pos = bisect_left(hits, start)
+    return hits[pos] if pos < len(hits) else None
+
+def subheading_boundaries(subheadings, line_number_map):
+    # One pass over the lines maps each subheading to the line it was detected on, keyed
+    # by (page, y). Returns a (start, end) line range per subheading, end exclusive;
+    # (None, None) when the heading can't be located. Headings whose line isn't in the
+    # map fall back to the first line (of 4+ characters) containing their snippet.
+    line_index = {}
+    for idx, entry in enumerate(line_number_map):
+        line_index.setdefault((entry["page"], entry["y"]), idx)
+
+    snippets = [heading_snippet(sh["text"]) for sh in subheadings]
+    snippet_hits = None
+
+    def find_snippet_line(i, start=0):
+        nonlocal snippet_hits
+        if snippet_hits is None:
+            snippet_hits = HeadingMatcher(snippets).scan(
+                entry["lower"] if len(entry["text"]) >= 4 else None for entry in line_number_map
+            )
+        return next_hit(snippet_hits[snippets[i]], start)
+
+    starts = []
+    for i, sh in enumerate(subheadings):
+        start = line_index.get((sh["page"], sh["y"]))
+        if start is None:
+            start = find_snippet_line(i)
+        starts.append(start)
+
+    boundaries = []
+    for i, start in enumerate(starts):
+        if start is None:
+            boundaries.append((None, None))
             continue
+        end = len(line_number_map)
+        if i + 1 < len(starts):
+            next_start = starts[i + 1]
+            if next_start is None or next_start <= start:
+                next_start = find_snippet_line(i + 1, start + 1)
+            if next_start is not None:
+                end = next_start
+        boundaries.append((start, end))
+    return boundaries
+
+def chunk_lines(line_number_map, start, end):
+    if start is None:
+        return []
+    return [entry["text"] for entry in line_number_map[start:end] if len(entry["text"]) >= 4]
+
+class ChunkWriter:
+    # Writes a section's chunks either as a txt_chunks/json_chunks file pair per chunk
+    # ("files") or as records appended to one chunks.jsonl ("jsonl"). A record is the
+    # chunk's JSON plus "id" (the chunk's file name base, stable across runs) and "section".
+    # `artifacts` lists every file written. Output left by the other mode is deleted so
+    # it can't be read in place of this run's chunks.
+    def __init__(self, folder_path, chunk_output="files"):
+        self.section = os.path.basename(folder_path)
+        self.chunk_output = chunk_output
+        self.artifacts = []
+        self.jsonl = None
+        self.jsonl_path = os.path.join(folder_path, "chunks.jsonl")
+        self.txt_dir = os.path.join(folder_path, "txt_chunks")
+        self.json_dir = os.path.join(folder_path, "json_chunks")
+        if chunk_output == "jsonl":
+            shutil.rmtree(self.txt_dir, ignore_errors=True)
+            shutil.rmtree(self.json_dir, ignore_errors=True)
+            open(self.jsonl_path, "w", encoding="utf-8").close()
+            self.artifacts.append(self.jsonl_path)
         else:
-            extracted_lines.append(line_text)
-    if extracted_lines:
-        full_text = "\n".join(extracted_lines)
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(full_text)
-        json_path = os.path.join(json_dir, os.path.basename(output_path).replace(".txt", ".json"))
+            if os.path.exists(self.jsonl_path):
+                os.remove(self.jsonl_path)
+            os.makedirs(self.txt_dir, exist_ok=True)
+            os.makedirs(self.json_dir, exist_ok=True)
+
+    def write(self, chunk_id, subheading_text, full_text):
+        # Returns where the chunk went: its txt path, or the section's chunks.jsonl
         json_data = {
-            "subheading": last_subheading['text'],
+            "subheading": subheading_text,
             "start_text": full_text[:50],
             "content": full_text
         }
+        if self.chunk_output == "jsonl":
+            if self.jsonl is None:
+                self.jsonl = open(self.jsonl_path, "a", encoding="utf-8")
+            record = {"id": chunk_id, "section": self.section, **json_data}
+            self.jsonl.write(json.dumps(record, ensure_ascii=False) + "\n")
+            return self.jsonl_path
+
+        txt_path = os.path.join(self.txt_dir, f"{chunk_id}.txt")
+        json_path = os.path.join(self.json_dir, f"{chunk_id}.json")
+        with open(txt_path, "w", encoding="utf-8") as f:
+            f.write(full_text)
         with open(json_path, "w", encoding="utf-8") as jf:
             json.dump(json_data, jf, indent=2)
-        print(f"✅ Saved last subheading extract to {output_path} and JSON")
-
-# === PER-SECTION LOOP ===
-for folder in os.listdir(output_dir):
-    folder_path = os.path.join(output_dir, folder)
-    if not os.path.isdir(folder_path):
-        continue
-
-    txt_dir = os.path.join(folder_path, "txt_chunks")
-    json_dir = os.path.join(folder_path, "json_chunks")
-    os.makedirs(txt_dir, exist_ok=True)
-    os.makedirs(json_dir, exist_ok=True)
-
-    pdf_file = None
-    for f in os.listdir(folder_path):
-        if f.endswith(".pdf"):
-            pdf_file = os.path.join(folder_path, f)
-            break
-    if not pdf_file:
-        continue
+        self.artifacts.extend([txt_path, json_path])
+        return txt_path
+
+    def close(self):
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
+
+def extract_last_subheading_to_section_end(last_subheading, line_number_map, writer, boundary=None):
+    if boundary is None:
+        boundary = subheading_boundaries([last_subheading], line_number_map)[0]
+    extracted_lines = chunk_lines(line_number_map, *boundary)
+    if extracted_lines:
+        full_text = "\n".join(extracted_lines)
+        chunk_id = f"extracted_last_{last_subheading['text'][:10].replace(' ','_')}_to_end"
+        output_path = writer.write(chunk_id, last_subheading['text'], full_text)
+        if writer.chunk_output == "jsonl":
+            print(f"✅ Saved last subheading extract to {output_path}")
+        else:
+            print(f"✅ Saved last subheading extract to {output_path} and JSON")
+
+def write_section_chunks(writer, subheadings, line_number_map):
+    boundaries = subheading_boundaries(subheadings, line_number_map)
+    try:
+        for i in range(len(subheadings) - 1):
+            extracted_lines = chunk_lines(line_number_map, *boundaries[i])
+            if extracted_lines:
+                filename_base = f"extracted_{i+1}_{subheadings[i]['text'][:10].replace(' ','_')}_to_{subheadings[i+1]['text'][:10].replace(' ','_')}"
+                writer.write(filename_base, subheadings[i]['text'], "\n".join(extracted_lines))
+
+        # 🔚 Handle last subheading to section end
+        extract_last_subheading_to_section_end(subheadings[-1], line_number_map, writer, boundaries[-1])
+    finally:
+        writer.close()
+
+def process_section(section, stream_pages=True, pool=None, pdf=None):
+    # Reads the section's page range straight from the source PDF; `pdf` may be that
+    # document already opened with pdfplumber
+    folder_path = section["folder_path"]
+    folder = os.path.basename(folder_path)
+    writer = ChunkWriter(folder_path, section.get("chunk_output", "files"))
+
+    source_pdf = section["source_pdf"]
+    page_numbers = section["page_numbers"]
+    glyph_cache = section.get("glyph_cache")
+    if not page_numbers:
+        return {"folder": folder, "status": "no pages"}
 
     print(f"\n[🔍] Subheading extraction for: {folder}")
 
-    text_data = extract_text_with_styles(pdf_file)
-    grouped_lines = group_text_by_position(text_data)
-
-    page_line_counter = {}
-    line_number_map = []
-    for line in grouped_lines:
-        page = line[0]["page"]
-        page_line_counter[page] = page_line_counter.get(page, 0) + 1
-        line_number_map.append({
-            "line": line,
-            "page": page,
-            "line_on_page": page_line_counter[page]
-        })
-
-    subheadings = detect_first_subheading(grouped_lines)
+    if stream_pages:
+        subheadings, line_number_map = detect_subheadings_from_pages(
+            iter_page_lines(source_pdf, pool=pool, page_numbers=page_numbers, pdf=pdf, cache=glyph_cache)
+        )
+    else:
+        text_data = extract_text_with_styles(
+            source_pdf, pool=pool, page_numbers=page_numbers, pdf=pdf, cache=glyph_cache
+        )
+        text_data, grouped_lines = group_text_by_position(text_data)
+        line_table = LineTable(text_data, grouped_lines)
+        line_number_map = build_line_number_map(line_table)
+        subheadings = detect_first_subheading(line_table)
     if not subheadings:
         print(f"[⚠️] No subheadings found in {folder}")
-        continue
-
-    excel_path = os.path.join(folder_path, f"{folder.split()[0]}_subheadings.xlsx")
-    df = pd.DataFrame([{"Subheading": s["text"], "Page No": s["page"]} for s in subheadings])
-    df.to_excel(excel_path, index=False)
-    complete_excel_sheet(pdf_file, excel_path, line_number_map)
-
-    for i in range(len(subheadings) - 1):
-        start_regex = re.escape(subheadings[i]['text'][:10].strip().lower())
-        end_regex = re.escape(subheadings[i+1]['text'][:10].strip().lower())
-        extracted_lines = []
-        start_found = False
-        for entry in line_number_map:
-            line_text = "".join(char["text"] for char in entry["line"]).strip()
-            line_text_lower = line_text.lower()
-            if len(line_text) < 4:
-                continue
-            if not start_found:
-                if re.search(start_regex, line_text_lower):
-                    start_found = True
-                    extracted_lines.append(line_text)
-                continue
-            else:
-                if re.search(end_regex, line_text_lower):
-                    break
-                extracted_lines.append(line_text)
-        if extracted_lines:
-            filename_base = f"extracted_{i+1}_{subheadings[i]['text'][:10].replace(' ','_')}_to_{subheadings[i+1]['text'][:10].replace(' ','_')}"
-            txt_path = os.path.join(txt_dir, f"{filename_base}.txt")
-            json_path = os.path.join(json_dir, f"{filename_base}.json")
-            full_text = "\n".join(extracted_lines)
-
-            with open(txt_path, "w", encoding="utf-8") as f:
-                f.write(full_text)
-
-            json_data = {
-                "subheading": subheadings[i]['text'],
-                "start_text": full_text[:50],
-                "content": full_text
-            }
-            with open(json_path, "w", encoding="utf-8") as jf:
-                json.dump(json_data, jf, indent=2)
-
-    # 🔚 Handle last subheading to section end
-    last_sh = subheadings[-1]
-    last_out_txt = os.path.join(txt_dir, f"extracted_last_{last_sh['text'][:10].replace(' ','_')}_to_end.txt")
-    extract_last_subheading_to_section_end(last_sh, line_number_map, last_out_txt, json_dir)
-
-# === CLEANUP: Remove section PDFs and subheadings Excel files ===
-for folder in os.listdir(output_dir):
-    folder_path = os.path.join(output_dir, folder)
-    if not os.path.isdir(folder_path):
-        continue
-
-    # Delete PDF file
-    for f in os.listdir(folder_path):
-        if f.endswith(".pdf"):
-            pdf_path = os.path.join(folder_path, f)
+        return {"folder": folder, "status": "no subheadings"}
+
+    subheading_table = build_subheading_table(subheadings, line_number_map)
+    write_section_chunks(writer, subheadings, line_number_map)
+    artifacts = writer.artifacts
+
+    if section.get("write_subheading_excel"):
+        excel_path = os.path.join(folder_path, f"{folder.split()[0]}_subheadings.xlsx")
+        pd.DataFrame(subheading_table).to_excel(excel_path, index=False)
+        artifacts.append(excel_path)
+
+    return {
+        "folder": folder,
+        "status": "done",
+        "subheadings": len(subheadings),
+        "subheading_table": subheading_table,
+        "artifacts": artifacts,
+    }
+
+def run_section(section, stream_pages=True, pool=None, pdf=None):
+    # Keeps one failing section from stopping the run; the error travels back in the result
+    try:
+        return process_section(section, stream_pages, pool, pdf)
+    except Exception:
+        folder = os.path.basename(section["folder_path"])
+        return {"folder": folder, "status": "failed", "error": traceback.format_exc()}
+
+# === SECTION MANIFEST (incremental re-runs) ===
+SECTION_PIPELINE_VERSION = 2  # bump when a change to this stage alters its outputs
+
+def section_input_hash(session, page_numbers):
+    # Hash of the decoded content streams of the section's pages in the source PDF
+    digest = hashlib.sha256()
+    for page_num in page_numbers:
+        contents = session.page(page_num - 1).get("/Contents")
+        if contents is not None:
+            contents = contents.get_object()
+            streams = contents if isinstance(contents, list) else [contents]
+            for stream in streams:
+                digest.update(stream.get_object().get_data())
+        digest.update(f"|page {page_num}|".encode())
+    return digest.hexdigest()
+
+def section_config_hash(section_config):
+    return hashlib.sha256(json.dumps(section_config, sort_keys=True).encode()).hexdigest()
+
+def load_section_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_section_manifest(manifest_path, manifest):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def section_is_current(entry, input_hash, config_hash, output_dir):
+    if not entry or entry["status"] == "failed":
+        return False
+    if entry["input_hash"] != input_hash or entry["config_hash"] != config_hash:
+        return False
+    for artifact in entry["artifacts"]:
+        artifact_path = os.path.join(output_dir, artifact["path"])
+        if not os.path.exists(artifact_path) or os.path.getsize(artifact_path) != artifact["size"]:
+            return False
+    return True
+
+def record_section_result(manifest, section, result, config_hash, output_dir):
+    # A failed section keeps its previous file list under status "failed", so it runs again
+    # and files the next successful run no longer produces are still removed
+    folder = result["folder"]
+    old_entry = manifest.pop(folder, None)
+    if result["status"] == "failed":
+        if old_entry:
+            manifest[folder] = dict(old_entry, status="failed")
+        return
+
+    artifacts = [
+        {"path": os.path.relpath(path, output_dir), "size": os.path.getsize(path)}
+        for path in result.get("artifacts", [])
+    ]
+    if old_entry:
+        produced = {artifact["path"] for artifact in artifacts}
+        for artifact in old_entry["artifacts"]:
+            stale_path = os.path.join(output_dir, artifact["path"])
+            if artifact["path"] not in produced and os.path.exists(stale_path):
+                os.remove(stale_path)
+
+    manifest[folder] = {
+        "input_hash": section["input_hash"],
+        "config_hash": config_hash,
+        "pages": [section["page_numbers"][0], section["page_numbers"][-1]] if section["page_numbers"] else [],
+        "status": result["status"],
+        "artifacts": artifacts,
+    }
+
+# === PER-SECTION LOOP ===
+if __name__ == "__main__":
+    glyph_cache = GlyphCache(glyph_cache_dir, session.content_hash()) if glyph_cache_dir else None
+    section_list = [sections[folder_path] for folder_path in sorted(sections)]
+    for section in section_list:
+        section["glyph_cache"] = glyph_cache
+        section["write_subheading_excel"] = write_subheading_excel
+        section["chunk_output"] = chunk_output
+
+    section_config = {
+        "pipeline_version": SECTION_PIPELINE_VERSION,
+        "write_subheading_excel": write_subheading_excel,
+        "chunk_output": chunk_output,
+    }
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    manifest = load_section_manifest(manifest_path)
+    config_hash = section_config_hash(section_config)
+    pending_sections = []
+    unchanged_results = {}
+    for section in section_list:
+        folder = os.path.basename(section["folder_path"])
+        section["input_hash"] = section_input_hash(session, section["page_numbers"])
+        if incremental and section_is_current(manifest.get(folder), section["input_hash"], config_hash, output_dir):
+            unchanged_results[folder] = {"folder": folder, "status": "unchanged"}
+        else:
+            pending_sections.append(section)
+
+    if section_workers > 1:
+        with ProcessPoolExecutor(max_workers=section_workers) as section_pool:
+            pending_results = list(section_pool.map(
+                run_section, pending_sections, [stream_pages] * len(pending_sections)
+            ))
+    else:
+        extraction_pool = ProcessPoolExecutor(max_workers=extraction_workers) if extraction_workers > 1 else None
+        shared_pdf = session.plumber() if extraction_pool is None else None
+        pending_results = [
+            run_section(section, stream_pages, extraction_pool, shared_pdf) for section in pending_sections
+        ]
+        if extraction_pool is not None:
+            extraction_pool.shutdown()
+
+    session.close()
+
+    for section, result in zip(pending_sections, pending_results):
+        record_section_result(manifest, section, result, config_hash, output_dir)
+    save_section_manifest(manifest_path, manifest)
+
+    pending_results = {result["folder"]: result for result in pending_results}
+    section_results = [
+        unchanged_results.get(os.path.basename(section["folder_path"]))
+        or pending_results[os.path.basename(section["folder_path"])]
+        for section in section_list
+    ]
+
+    for result in section_results:
+        if result["status"] == "failed":
+            print(f"[❌] Section {result['folder']} failed:\n{result['error']}")
+        else:
+            print(f"[✔] {result['folder']}: {result['status']}")
+
+    # === CLEANUP: Remove leftover section PDFs and subheadings Excel files ===
+    for folder in os.listdir(output_dir):
+        folder_path = os.path.join(output_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+
+        # Delete PDF file (unless section PDFs were asked for)
+        for f in os.listdir(folder_path):
+            if f.endswith(".pdf") and not write_section_pdfs:
+                section_pdf_path = os.path.join(folder_path, f)
+                try:
+                    os.remove(section_pdf_path)
+                except Exception as e:
+                    print(f"[❌] Failed to delete PDF {section_pdf_path}: {e}")
+
+        # Delete Excel file (unless the subheading tables were exported on purpose)
+        section_id = folder.split()[0]  # e.g., '3.1' from '3.1 Section Name'
+        excel_filename = f"{section_id}_subheadings.xlsx"
+        excel_path = os.path.join(folder_path, excel_filename)
+        if os.path.exists(excel_path) and not write_subheading_excel:
             try:
-                os.remove(pdf_path)
+                os.remove(excel_path)
             except Exception as e:
-                print(f"[❌] Failed to delete PDF {pdf_path}: {e}")
-
-    # Delete Excel file
-    section_id = folder.split()[0]  # e.g., '3.1' from '3.1 Section Name'
-    excel_filename = f"{section_id}_subheadings.xlsx"
-    excel_path = os.path.join(folder_path, excel_filename)
-    if os.path.exists(excel_path):
-        try:
-            os.remove(excel_path)
-        except Exception as e:
-            print(f"[❌] Failed to delete Excel {excel_path}: {e}")
+                print(f"[❌] Failed to delete Excel {excel_path}: {e}")
 
-# Delete main TXT file
-    txt_filename = f"{folder}.txt"  # e.g., '3.1 Section Name.txt'
-    txt_path = os.path.join(folder_path, txt_filename)
-    if os.path.exists(txt_path):
-        try:
-            os.remove(txt_path)
-        except Exception as e:
-            print(f"[❌] Failed to delete TXT {txt_path}: {e}")
+    # Delete main TXT file
+        txt_filename = f"{folder}.txt"  # e.g., '3.1 Section Name.txt'
+        txt_path = os.path.join(folder_path, txt_filename)
+        if os.path.exists(txt_path):
+            try:
+                os.remove(txt_path)
+            except Exception as e:
+                print(f"[❌] Failed to delete TXT {txt_path}: {e}")
 
 import os
 import json
 import pandas as pd
-from langchain_ollama import OllamaLLM
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
 import re
+import hashlib
+import sqlite3
+import asyncio
+import queue
+import threading
 
 # === Directories ===
 base_dir = "extracted_sections"
 output_json_dir = os.path.join("outputs", "json")
 output_excel_dir = os.path.join("outputs", "excel")
 master_excel_path = os.path.join("outputs", "master_subpolicies.xlsx")
+master_log_path = os.path.join("outputs", "master_subpolicies.jsonl")
 
-os.makedirs(output_json_dir, exist_ok=True)
-os.makedirs(output_excel_dir, exist_ok=True)
-
-# === Initialize LLM ===
-llm = OllamaLLM(model="mistral:7b-instruct", options={"num_gpu_layers": 0})
+# === LLM model (one OllamaLLM per context size, see context_chain) ===
+llm_model = "mistral:7b-instruct"
+llm_options = {"num_gpu_layers": 0}
 
 # === Prompt (strict, unchanged) ===
-prompt_template = PromptTemplate.from_template("""
+prompt_text = """
 You are given a raw policy text with clearly labeled sections such as:
 
 - Control:
@@ -564,127 +1248,821 @@ Here is the document:
 {text}
 
 Return only the JSON object. Do not include any extra explanation or markdown.
-""")
+"""
 
-chain = LLMChain(llm=llm, prompt=prompt_template)
+# === Prompt (boundaries only) ===
+boundary_prompt_text = """
+You are given a raw policy text. Every line starts with its line number followed by "|".
+The text has clearly labeled sections such as:
 
-# === State ===
-subpolicy_counter = 1
-master_rows = []
-last_heading_written = None
+- Control:
+- Discussion:
+- Related Controls:
+- Control Enhancements:
+- References:
 
-# === Traverse all folders ===
-for section in sorted(os.listdir(base_dir)):
-    section_path = os.path.join(base_dir, section)
-    if not os.path.isdir(section_path):
-        continue
+Your task is to locate each section, NOT to copy it.
 
-    txt_dir = os.path.join(section_path, "txt_chunks")
-    if not os.path.isdir(txt_dir):
-        print(f"⚠️ No txt_chunks in {section}")
-        continue
+⚠️ INSTRUCTIONS:
+- A section starts on the line holding its heading (including the colon) and ends on the line before the next valid heading.
+- Return each section as [first line number, last line number].
+- If a section is missing, return null.
+- Do NOT copy any text from the sections.
 
-    # Insert heading row once per section
-    if last_heading_written != section:
-        heading_row = {"PolicyId": f"HEADING {section}"}
-        master_rows.append(heading_row)
-        last_heading_written = section
+You must return a valid JSON object in this format:
+
+{{
+  "PolicyId": "...",              // e.g., AC-2
+  "PolicyName": "...",            // title of the policy before first heading
+  "Control": [3, 9],
+  "Discussion": [10, 24],
+  "ControlEnhancements": null,
+  "RelatedControls": [25, 25],
+  "References": [26, 27]
+}}
+
+Infer only the PolicyId and PolicyName from the first few lines before any section.
+
+Here are the numbered lines:
+
+{text}
 
+Return only the JSON object. Do not include any extra explanation or markdown.
+"""
+
+def iter_section_chunks(section_path, chunk_output="files"):
+    # (file name, source, text) for each chunk of a section, from its chunks.jsonl or its
+    # txt_chunks/ as chunk_output says; in file name order either way
+    jsonl_path = os.path.join(section_path, "chunks.jsonl")
+    if chunk_output == "jsonl":
+        with open(jsonl_path, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        for record in sorted(records, key=lambda r: f"{r['id']}.txt"):
+            yield f"{record['id']}.txt", f"{jsonl_path}#{record['id']}", record["content"]
+        return
+
+    txt_dir = os.path.join(section_path, "txt_chunks")
     for file in sorted(os.listdir(txt_dir)):
         if not file.endswith(".txt"):
             continue
-
         txt_path = os.path.join(txt_dir, file)
-        print(f"🔍 Processing: {txt_path}")
-
         with open(txt_path, "r", encoding="utf-8") as f:
-            raw_text = f.read()
+            yield file, txt_path, f.read()
+
+# === Deterministic control parser ===
+HEADINGS_ORDER = [
+    "Control",
+    "Discussion",
+    "Related Controls",
+    "Control Enhancements",
+    "References"
+]
+
+# First "XX-n TITLE" on the chunk's first line; stray margin glyphs around it are skipped
+CONTROL_HEADING_RE = re.compile(r"([A-Z]{2}-\d+)\s+([A-Z0-9][A-Z0-9 ,;'’&/()\-—–]*)")
+
+def extract_section_ordered(label, text):
+    label_escaped = re.escape(label)
+    current_idx = HEADINGS_ORDER.index(label)
+
+    # Headings after the current heading
+    next_headings = HEADINGS_ORDER[current_idx + 1:]
+
+    lookahead = "|".join([rf"{re.escape(h)}:" for h in next_headings]) if next_headings else "$"
+
+    pattern = rf"{label_escaped}:(.*?)(?=({lookahead})|$)"
+
+    match = re.search(pattern, text, re.DOTALL)
+    return match.group(1).strip() if match else "None"
+
+# Output field of each heading, in the order the prompt lists the fields
+SECTION_FIELDS = {
+    "Control": "Control",
+    "Discussion": "Discussion",
+    "Control Enhancements": "ControlEnhancements",
+    "Related Controls": "RelatedControls",
+    "References": "References",
+}
+
+def control_is_valid(policy_data, text):
+    # The chunk needs a Control section, every label it contains must have text under it,
+    # and the labels must first appear in HEADINGS_ORDER order
+    if policy_data["Control"] in ("", "None"):
+        return False
+    last_position = -1
+    for label in HEADINGS_ORDER:
+        match = re.search(rf"{re.escape(label)}:", text)
+        if match is None:
+            continue
+        if match.start() < last_position or policy_data[SECTION_FIELDS[label]] in ("", "None"):
+            return False
+        last_position = match.start()
+    return True
+
+def parse_control_text(text):
+    # The fields the LLM prompt asks for, pulled out with regex; None when the chunk doesn't
+    # validate and has to go to the LLM
+    first_line = text.strip().split("\n", 1)[0]
+    heading = CONTROL_HEADING_RE.search(first_line)
+    if heading is None:
+        return None
+    policy_data = {
+        "PolicyId": heading.group(1),
+        "PolicyName": heading.group(2).strip(),
+        "Control": extract_section_ordered("Control", text),
+        "Discussion": extract_section_ordered("Discussion", text),
+        "ControlEnhancements": extract_section_ordered("Control Enhancements", text),
+        "RelatedControls": extract_section_ordered("Related Controls", text),
+        "References": extract_section_ordered("References", text),
+    }
+    return policy_data if control_is_valid(policy_data, text) else None
+
+# === Boundary protocol ===
+def number_lines(text):
+    # "n| line" for every line, numbered from 1, so the model can answer with line ranges
+    return "\n".join(f"{number}| {line}" for number, line in enumerate(text.split("\n"), start=1))
+
+def slice_section(lines, label, span):
+    # Lines first..last (1-based, inclusive), starting after the heading label
+    if not isinstance(span, (list, tuple)) or len(span) != 2:
+        return "None"
+    try:
+        first, last = int(span[0]), int(span[1])
+    except (TypeError, ValueError):
+        return "None"
+    first = max(first, 1)
+    last = min(last, len(lines))
+    if first > last:
+        return "None"
+    section_lines = lines[first - 1:last]
+    # Margin glyphs or the tail of the previous section can precede the label on its line
+    section_lines[0] = section_lines[0].split(f"{label}:", 1)[-1]
+    return "\n".join(section_lines).strip() or "None"
+
+def slice_boundaries(boundaries, text):
+    # Turns the model's {field: [first, last]} answer into the usual verbatim fields,
+    # sliced from the chunk text that was numbered for the prompt
+    lines = text.split("\n")
+    policy_data = {
+        "PolicyId": str(boundaries.get("PolicyId") or ""),
+        "PolicyName": str(boundaries.get("PolicyName") or ""),
+    }
+    for label, field in SECTION_FIELDS.items():
+        policy_data[field] = slice_section(lines, label, boundaries.get(field))
+    return policy_data
+
+def clean_json_response(response):
+    json_text = response.strip()
+    if json_text.startswith("```"):
+        json_text = json_text.strip("```").strip()
+    if json_text.startswith("json"):
+        json_text = json_text[4:].strip()
+
+    # Remove any markdown code fences ```json ... ```
+    json_text = re.sub(r"```(json)?\s*|\s*```", "", json_text)
+    json_text = re.sub(r'\\(?![\"\\/bfnrt])', r'\\\\', json_text)
+
+    # Remove any lines not part of JSON (e.g., lines before the first { or after the last })
+    json_start = json_text.find('{')
+    json_end = json_text.rfind('}')
+    if json_start != -1 and json_end != -1:
+        json_text = json_text[json_start:json_end+1]
+
+    # Optional: strip leading/trailing whitespace again after slicing
+    return json_text.strip()
+
+# === Context-window guard ===
+context_encodings = {}
+
+def context_encoding():
+    # Loaded on first use: tiktoken downloads the encoding the first time, and the PDF
+    # stage's pool workers import this module without ever counting tokens
+    if "cl100k_base" not in context_encodings:
+        import tiktoken
+        context_encodings["cl100k_base"] = tiktoken.get_encoding("cl100k_base")
+    return context_encodings["cl100k_base"]
+
+token_safety_factor = 1.3  # cl100k counts run below mistral's tokenizer, so estimates are padded
+output_reserve_tokens = 256  # JSON keys, PolicyId/PolicyName, or the whole answer in boundary mode
+context_overlap = 50  # tokens repeated between pieces of a section that is split on its own
+
+# Ollama reloads the model whenever num_ctx changes, so sizes come from a short ladder
+CONTEXT_SIZES = [2048, 4096, 8192, 16384, 32768]
+
+# Chunker copied from gpt_single_extra.py; only the tokenizer differs
+UNIT_START_RE = re.compile(
+    r"^.?(?:Control|Discussion|Related Controls|Control Enhancements|References):|^.?(?:\|\s*)?\(\d+\)\s",
+    re.MULTILINE,
+)
+
+def count_tokens(text):
+    return len(context_encoding().encode(text))
+
+def estimate_tokens(text):
+    return int(count_tokens(text) * token_safety_factor) + 1
+
+def required_context(prompt, text, protocol):
+    # Rendered prompt plus room for the answer; verbatim answers repeat the text inside JSON
+    llm_text = number_lines(text) if protocol == "boundaries" else text
+    output_tokens = output_reserve_tokens + (estimate_tokens(text) if protocol == "verbatim" else 0)
+    return estimate_tokens(prompt.format(text=llm_text)) + output_tokens
+
+def context_size_for(tokens, max_ctx):
+    for size in CONTEXT_SIZES:
+        if tokens <= size <= max_ctx:
+            return size
+    return None
+
+def split_structural_units(text):
+    starts = [m.start() for m in UNIT_START_RE.finditer(text) if m.start() > 0]
+    bounds = [0] + starts + [len(text)]
+    return [text[a:b] for a, b in zip(bounds, bounds[1:]) if text[a:b]]
+
+def split_oversized_unit(unit, chunk_size, overlap):
+    encoding = context_encoding()
+    line_limit = chunk_size - overlap
+    lines = []
+    for line in unit.splitlines(keepends=True):
+        line_tokens = encoding.encode(line)
+        for s in range(0, len(line_tokens), line_limit):
+            window = line_tokens[s:s + line_limit]
+            lines.append((line if len(window) == len(line_tokens) else encoding.decode(window), len(window)))
+
+    pieces = []
+    current, current_tokens = [], 0
+    for line, line_count in lines:
+        if current and current_tokens + line_count > chunk_size:
+            pieces.append("".join(l for l, _ in current))
+            carried, carried_tokens = [], 0
+            for l, n in reversed(current):
+                if carried_tokens + n > overlap:
+                    break
+                carried.insert(0, (l, n))
+                carried_tokens += n
+            current, current_tokens = carried, carried_tokens
+        current.append((line, line_count))
+        current_tokens += line_count
+    if current:
+        pieces.append("".join(l for l, _ in current))
+    return pieces
+
+def chunk_by_structure(text, chunk_size, overlap):
+    chunks = []
+    current, current_tokens = [], 0
+    for unit in split_structural_units(text):
+        unit_tokens = count_tokens(unit)
+        if current and current_tokens + unit_tokens > chunk_size:
+            chunks.append("".join(current))
+            current, current_tokens = [], 0
+        if unit_tokens > chunk_size:
+            chunks.extend(split_oversized_unit(unit, chunk_size, overlap))
+            continue
+        current.append(unit)
+        current_tokens += unit_tokens
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+def plan_llm_requests(text, prompt, protocol, max_ctx):
+    # [(piece, num_ctx)] for one chunk: the whole chunk at the smallest context that fits it,
+    # or pieces cut at section boundaries when even max_ctx is too small
+    num_ctx = context_size_for(required_context(prompt, text, protocol), max_ctx)
+    if num_ctx is not None:
+        return [(text, num_ctx)]
+
+    overhead = required_context(prompt, "", protocol)
+    budget = int((max_ctx - overhead) / (token_safety_factor * (2 if protocol == "verbatim" else 1)))
+    while budget > 2 * context_overlap:
+        plan = [
+            (piece, context_size_for(required_context(prompt, piece, protocol), max_ctx))
+            for piece in chunk_by_structure(text, budget, context_overlap)
+        ]
+        if all(num_ctx is not None for _, num_ctx in plan):
+            return plan
+        budget = budget * 3 // 4  # line numbers or dense text took more than estimated
+
+    print(f"⚠️ Prompt doesn't fit in llm_max_ctx={max_ctx}, sending the chunk as is")
+    return [(text, max_ctx)]
+
+def context_chain(prompt, num_ctx):
+    # One chain per prompt and context size, all on the same model
+    key = (prompt.template, num_ctx)
+    if key not in context_chains:
+        context_llm = OllamaLLM(model=llm_model, options=llm_options, num_ctx=num_ctx)
+        context_chains[key] = LLMChain(llm=context_llm, prompt=prompt)
+    return context_chains[key]
+
+context_chains = {}
+
+# Overlap detection copied from gpt_single_extra.py
+min_overlap_chars = 20
+
+def overlap_length(previous, following):
+    if not following:
+        return 0
+    combined = following + "\0" + previous[-len(following):]
+    prefix = [0] * len(combined)
+    for i in range(1, len(combined)):
+        k = prefix[i - 1]
+        while k and combined[i] != combined[k]:
+            k = prefix[k - 1]
+        if combined[i] == combined[k]:
+            k += 1
+        prefix[i] = k
+    return prefix[-1]
+
+def merge_sections(results):
+    # Differs from gpt_single_extra.py's merge_sections on purpose: "None" pieces are skipped
+    # and the ids stay strings, so the result is a regular master row. Returns the fields and
+    # how many characters of piece overlap were dropped
+    merged = {
+        "PolicyId": "",
+        "PolicyName": "",
+        "Control": [],
+        "Discussion": [],
+        "ControlEnhancements": [],
+        "RelatedControls": [],
+        "References": []
+    }
+    deduplicated_chars = 0
+
+    for r in results:
+        for key in ["PolicyId", "PolicyName"]:
+            if not merged[key] and r.get(key) and r[key] != "None":
+                merged[key] = str(r[key])
+
+        for key in ["Control", "Discussion", "ControlEnhancements", "RelatedControls", "References"]:
+            cleaned = str(r.get(key) or "").strip()
+            if not cleaned or cleaned == "None":
+                continue
+            if merged[key]:
+                shared = overlap_length(merged[key][-1], cleaned)
+                if shared >= min_overlap_chars:
+                    merged[key][-1] += cleaned[shared:]
+                    deduplicated_chars += shared
+                    continue
+            merged[key].append(cleaned)
+
+    for key in merged:
+        if isinstance(merged[key], list):
+            merged[key] = "\n".join(merged[key]) if merged[key] else "None"
+
+    return merged, deduplicated_chars
+
+# === LLM response cache ===
+class LLMResponseCache:
+    # LLM responses on disk, keyed by a hash of the model, its generation options, the prompt
+    # template and the normalized chunk text, so unchanged chunks skip the model on re-runs.
+    # Least recently used entries are evicted once the cache grows past max_bytes.
+    def __init__(self, cache_dir, model, options, prompt_template, max_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.key_prefix = json.dumps(
+            {"model": model, "options": options, "prompt_template": prompt_template}, sort_keys=True
+        )
+        self.hits = 0
+        self.misses = 0
+        self.recount_every = 100
+        self.saves_since_recount = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = self.disk_bytes()
+
+    def entries(self):
+        return [
+            os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".json")
+        ]
+
+    def entry_stats(self):
+        # (mtime, size, path) of every entry, skipping files another process just evicted
+        stats = []
+        for path in self.entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            stats.append((stat.st_mtime, stat.st_size, path))
+        return stats
+
+    def disk_bytes(self):
+        return sum(size for _, size, _ in self.entry_stats())
 
-        normalized_text = raw_text.replace("\r\n", "\n").replace("\n\n", "\n")
+    def path(self, text):
+        key = hashlib.sha256(f"{self.key_prefix}\0{text}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json")
 
+    def load(self, text):
+        path = self.path(text)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                response = json.load(f)["response"]
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)  # marks the entry as recently used
+        except FileNotFoundError:
+            pass  # evicted by another process since it was read
+        self.hits += 1
+        return response
+
+    def entry_size(self, path):
+        # 0 when the entry doesn't exist, including when another process just evicted it
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    def save(self, text, response):
+        path = self.path(text)
+        old_size = self.entry_size(path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"response": response}, f)
+        os.replace(tmp_path, path)
+        self.total_bytes += self.entry_size(path) - old_size
+        self.saves_since_recount += 1
+        # total_bytes only tracks this process's writes; final.py and gpt_full_extra.py can
+        # share cache_dir, so the directory is recounted every recount_every saves and
+        # before anything is evicted
+        if self.total_bytes > self.max_bytes or self.saves_since_recount >= self.recount_every:
+            self.total_bytes = self.disk_bytes()
+            self.saves_since_recount = 0
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Drops the least recently used entries down to 90% of max_bytes, so a full cache
+        # isn't rescanned on every save
+        for _, size, path in sorted(self.entry_stats()):
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # evicted by another process in the meantime
+            self.total_bytes -= size
+
+# === Async LLM dispatch ===
+async def ainvoke_with_retries(chain, text, semaphore, retries, retry_delay, cache=None):
+    if cache is not None:
+        response = cache.load(text)
+        if response is not None:
+            return response
+    async with semaphore:
+        for attempt in range(retries + 1):
+            try:
+                response = (await chain.ainvoke({"text": text}))["text"]
+                if cache is not None:
+                    cache.save(text, response)
+                return response
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                print(f"⚠️ LLM request failed ({e}), retry {attempt + 1}/{retries}")
+                await asyncio.sleep(retry_delay * 2 ** attempt)
+
+async def dispatch_in_order(requests, results, concurrency, retries, retry_delay, cache=None):
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [
+        asyncio.create_task(ainvoke_with_retries(chain, text, semaphore, retries, retry_delay, cache))
+        for chain, text in requests
+    ]
+    for task in tasks:
+        try:
+            results.put((await task, None))
+        except Exception as e:
+            results.put((None, e))
+
+def iter_llm_responses(requests, concurrency=4, retries=2, retry_delay=1.0, cache=None):
+    # Sends every (chain, text) request through chain.ainvoke with at most `concurrency`
+    # requests in flight, on an event loop in a background thread; texts found in `cache`
+    # skip the model. Yields (response, error) in input order, each as soon as it and
+    # everything before it are done, so results can be saved while later requests are
+    # still running.
+    results = queue.Queue()
+    worker = threading.Thread(
+        target=asyncio.run,
+        args=(dispatch_in_order(requests, results, concurrency, retries, retry_delay, cache),),
+        daemon=True,
+    )
+    worker.start()
+    for _ in requests:
+        yield results.get()
+    worker.join()
+
+# === Master table ===
+def build_master_excel(log_path, excel_path):
+    with open(log_path, "r", encoding="utf-8") as f:
+        master_rows = [json.loads(line) for line in f if line.strip()]
+    pd.DataFrame(master_rows).to_excel(excel_path, index=False)
+
+class MasterTableWriter:
+    # Appends each master row to a JSON Lines log as it arrives, synced to disk so a crashed
+    # run keeps every row written so far. The workbook is built from the log only on flush(),
+    # instead of being rewritten after every record; build_master_excel() rebuilds it from
+    # a log left by an interrupted run.
+    def __init__(self, log_path, excel_path):
+        self.log_path = log_path
+        self.excel_path = excel_path
+        self.log = open(log_path, "w", encoding="utf-8")
+
+    def append(self, row):
+        self.log.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.log.flush()
+        os.fsync(self.log.fileno())
+
+    def flush(self):
+        self.log.flush()
+        build_master_excel(self.log_path, self.excel_path)
+
+    def close(self):
+        self.flush()
+        self.log.close()
+
+# === Corpus store (SQLite + FTS5) ===
+POLICY_FIELDS = ["PolicyId", "PolicyName", "Control", "Discussion", "ControlEnhancements", "RelatedControls", "References"]
+
+class CorpusStore:
+    # Sections, their chunks and the structured policies in one SQLite database, keyed by
+    # (section, chunk_id) where chunk_id is the chunk's file name base. chunks_fts and
+    # policies_fts index the text for full-text search when SQLite has FTS5.
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        policy_columns = ", ".join(f'"{field}" TEXT' for field in POLICY_FIELDS)
+        self.conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS sections (
+                section TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                section TEXT NOT NULL REFERENCES sections(section) ON DELETE CASCADE,
+                chunk_id TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (section, chunk_id)
+            );
+            CREATE TABLE IF NOT EXISTS policies (
+                section TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                {policy_columns},
+                data TEXT NOT NULL,
+                PRIMARY KEY (section, chunk_id),
+                FOREIGN KEY (section, chunk_id) REFERENCES chunks(section, chunk_id) ON DELETE CASCADE
+            );
+        """)
+        fts_columns = ", ".join(f'"{field}"' for field in POLICY_FIELDS)
         try:
-            response = chain.invoke({"text": normalized_text})["text"]
+            self.conn.executescript(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+                    section UNINDEXED, chunk_id UNINDEXED, content
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS policies_fts USING fts5(
+                    section UNINDEXED, chunk_id UNINDEXED, {fts_columns}
+                );
+            """)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print(f"⚠️ FTS5 not available ({e}); corpus store will not be full-text indexed")
+            self.fts = False
+
+    def begin_section(self, section):
+        # Replaces whatever an earlier run stored for the section
+        if self.fts:
+            self.conn.execute("DELETE FROM chunks_fts WHERE section = ?", (section,))
+            self.conn.execute("DELETE FROM policies_fts WHERE section = ?", (section,))
+        self.conn.execute("DELETE FROM sections WHERE section = ?", (section,))
+        self.conn.execute("INSERT INTO sections (section) VALUES (?)", (section,))
+
+    def add_chunk(self, section, chunk_id, content):
+        self.conn.execute(
+            "INSERT INTO chunks (section, chunk_id, content) VALUES (?, ?, ?)", (section, chunk_id, content)
+        )
+        if self.fts:
+            self.conn.execute(
+                "INSERT INTO chunks_fts (section, chunk_id, content) VALUES (?, ?, ?)", (section, chunk_id, content)
+            )
 
-            json_text = response.strip()
-            if json_text.startswith("```"):
-                json_text = json_text.strip("```").strip()
-            if json_text.startswith("json"):
-                json_text = json_text[4:].strip()
+    def add_policy(self, section, chunk_id, policy_data):
+        values = []
+        for field in POLICY_FIELDS:
+            value = policy_data.get(field)
+            values.append(value if value is None or isinstance(value, str) else json.dumps(value))
+        columns = ", ".join(f'"{field}"' for field in POLICY_FIELDS)
+        placeholders = ", ".join("?" for _ in POLICY_FIELDS)
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO policies (section, chunk_id, {columns}, data) VALUES (?, ?, {placeholders}, ?)",
+            [section, chunk_id, *values, json.dumps(policy_data)],
+        )
+        if self.fts:
+            self.conn.execute("DELETE FROM policies_fts WHERE section = ? AND chunk_id = ?", (section, chunk_id))
+            self.conn.execute(
+                f"INSERT INTO policies_fts (section, chunk_id, {columns}) VALUES (?, ?, {placeholders})",
+                [section, chunk_id, *values],
+            )
 
-            import re
+    def search(self, query, limit=20):
+        # Policies containing `query` as plain text, e.g. "AC-1" or "cryptographic key": an
+        # FTS5 phrase match, best match first, or a substring match on every field without FTS5
+        if self.fts:
+            phrase = '"' + query.replace('"', '""') + '"'
+            rows = self.conn.execute(
+                "SELECT section, chunk_id, PolicyId, PolicyName FROM policies_fts "
+                "WHERE policies_fts MATCH ? ORDER BY rank LIMIT ?",
+                (phrase, limit),
+            )
+        else:
+            pattern = "%" + query.replace("!", "!!").replace("%", "!%").replace("_", "!_") + "%"
+            condition = " OR ".join(f'"{field}" LIKE ? ESCAPE \'!\'' for field in POLICY_FIELDS)
+            rows = self.conn.execute(
+                f"SELECT section, chunk_id, PolicyId, PolicyName FROM policies WHERE {condition} LIMIT ?",
+                [pattern] * len(POLICY_FIELDS) + [limit],
+            )
+        return rows.fetchall()
 
-            # Remove any markdown code fences ```json ... ```
-            json_text = re.sub(r"```(json)?\s*|\s*```", "", json_text)
-            json_text = re.sub(r'\\(?![\"\\/bfnrt])', r'\\\\', json_text)
+    def commit(self):
+        self.conn.commit()
 
-            # Remove any lines not part of JSON (e.g., lines before the first { or after the last })
-            json_start = json_text.find('{')
-            json_end = json_text.rfind('}')
-            if json_start != -1 and json_end != -1:
-                json_text = json_text[json_start:json_end+1]
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
 
-            # Optional: strip leading/trailing whitespace again after slicing
-            json_text = json_text.strip()
+# === State ===
+if __name__ == "__main__":
+    from langchain_ollama import OllamaLLM
+    from langchain.prompts import PromptTemplate
+    from langchain.chains import LLMChain
+
+    os.makedirs(output_json_dir, exist_ok=True)
+    os.makedirs(output_excel_dir, exist_ok=True)
+
+    prompt_template = PromptTemplate.from_template(prompt_text)
+    boundary_prompt_template = PromptTemplate.from_template(boundary_prompt_text)
+
+    subpolicy_counter = 1
+    master = MasterTableWriter(master_log_path, master_excel_path)
+    last_heading_written = None
+    corpus = CorpusStore(corpus_db_path) if corpus_db_path else None
+    active_prompt = boundary_prompt_template if llm_protocol == "boundaries" else prompt_template
+    # num_ctx follows from the text and llm_max_ctx, so llm_max_ctx is part of the key
+    response_cache = (
+        LLMResponseCache(
+            llm_cache_dir, llm_model, dict(llm_options, llm_max_ctx=llm_max_ctx),
+            active_prompt.template, llm_cache_max_bytes,
+        )
+        if llm_cache_dir else None
+    )
+
+    # === Collect chunks of all folders and start the LLM requests ===
+    section_chunks = []
+    for section in sorted(os.listdir(base_dir)):
+        section_path = os.path.join(base_dir, section)
+        if not os.path.isdir(section_path):
+            continue
+
+        if chunk_output == "jsonl":
+            if not os.path.isfile(os.path.join(section_path, "chunks.jsonl")):
+                print(f"⚠️ No chunks.jsonl in {section}")
+                continue
+        elif not os.path.isdir(os.path.join(section_path, "txt_chunks")):
+            print(f"⚠️ No txt_chunks in {section}")
+            continue
+
+        chunks = []
+        for file, source, raw_text in iter_section_chunks(section_path, chunk_output):
+            normalized_text = raw_text.replace("\r\n", "\n").replace("\n\n", "\n")
+            parsed = parse_control_text(normalized_text) if structuring == "regex_first" else None
+            # Only chunks the regex parser couldn't structure go to the LLM, split if they don't fit
+            plan = (
+                plan_llm_requests(normalized_text, active_prompt, llm_protocol, llm_max_ctx)
+                if parsed is None else []
+            )
+            chunks.append((file, source, raw_text, parsed, plan))
+        section_chunks.append((section, chunks))
+
+    llm_requests = [
+        (context_chain(active_prompt, num_ctx), number_lines(piece) if llm_protocol == "boundaries" else piece)
+        for _, chunks in section_chunks
+        for _, _, _, _, plan in chunks
+        for piece, num_ctx in plan
+    ]
+    llm_chunk_count = sum(1 for _, chunks in section_chunks for _, _, _, parsed, _ in chunks if parsed is None)
+    print(f"🧩 Regex parser structured {sum(len(chunks) for _, chunks in section_chunks) - llm_chunk_count} chunks; "
+          f"{llm_chunk_count} go to the LLM in {len(llm_requests)} requests")
+    responses = iter_llm_responses(
+        llm_requests, llm_concurrency, llm_retries, cache=response_cache
+    )
 
+    # === Traverse all folders ===
+    for section, chunks in section_chunks:
+        # Insert heading row once per section
+        if last_heading_written != section:
+            heading_row = {"PolicyId": f"HEADING {section}"}
+            master.append(heading_row)
+            last_heading_written = section
+
+        if corpus is not None:
+            corpus.begin_section(section)
+
+        for file, source, raw_text, parsed, plan in chunks:
+            print(f"🔍 Processing: {source}")
+            chunk_id = os.path.splitext(file)[0]
+            if corpus is not None:
+                corpus.add_chunk(section, chunk_id, raw_text)
+
+            piece_responses = [next(responses) for _ in plan]
             try:
-                policy_data = json.loads(json_text, strict=False)
+                if parsed is not None:
+                    policy_data = parsed
+                    response = json.dumps(parsed, indent=2, ensure_ascii=False)
+                else:
+                    partial_results = []
+                    for (piece, _), (response, llm_error) in zip(plan, piece_responses):
+                        if llm_error is not None:
+                            raise llm_error
 
-                # Your existing handling here...
-                for key in policy_data:
-                    if isinstance(policy_data[key], list):
-                        policy_data[key] = "; ".join(str(item) for item in policy_data[key])
+                        json_text = clean_json_response(response)
 
-            except json.JSONDecodeError as json_err:
-                print(f"❌ JSON decode error in {file}: {json_err}")
+                        try:
+                            partial = json.loads(json_text, strict=False)
+                            if llm_protocol == "boundaries":
+                                partial = slice_boundaries(partial, piece)
 
-                error_log_path = os.path.join("outputs", "json", "error_" + file.replace(".txt", ".json"))
-                with open(error_log_path, "w", encoding="utf-8") as ef:
-                    ef.write(json_text)
-                
-                continue  # Skip this file and move on
+                            # Your existing handling here...
+                            for key in partial:
+                                if isinstance(partial[key], list):
+                                    partial[key] = "; ".join(str(item) for item in partial[key])
+                            partial_results.append(partial)
 
-            # === Save files ===
-            # === Clean Policy ID ===
-            raw_policy_id = policy_data.get("PolicyId", "").strip()
+                        except json.JSONDecodeError as json_err:
+                            print(f"❌ JSON decode error in {file}: {json_err}")
 
-            # Use fallback if missing or invalid
-            if not raw_policy_id:
-                raw_policy_id = f"subpolicy_{subpolicy_counter}"
+                            error_log_path = os.path.join("outputs", "json", "error_" + file.replace(".txt", ".json"))
+                            with open(error_log_path, "w", encoding="utf-8") as ef:
+                                ef.write(json_text)
+                            break
 
-            policy_id = raw_policy_id.replace("/", "-").replace("\\", "-").replace(" ", "_")
+                    if len(partial_results) < len(plan):
+                        continue  # Skip this file and move on
 
-            subpolicy_counter += 1
+                    if len(partial_results) == 1:
+                        policy_data = partial_results[0]
+                    else:
+                        policy_data, deduplicated_chars = merge_sections(partial_results)
+                        response = "\n\n".join(piece_response for piece_response, _ in piece_responses)
+                        print(f"🧩 Merged {len(plan)} parts of {file}, {deduplicated_chars} overlapping characters deduplicated")
 
-            # === Create section folders ===
-            json_section_dir = os.path.join(output_json_dir, section)
-            excel_section_dir = os.path.join(output_excel_dir, section)
-            os.makedirs(json_section_dir, exist_ok=True)
-            os.makedirs(excel_section_dir, exist_ok=True)
+                # === Save files ===
+                # === Clean Policy ID ===
+                raw_policy_id = policy_data.get("PolicyId", "").strip()
 
-            # === Output paths ===
-            json_path = os.path.join(json_section_dir, f"{policy_id}.json")
-            excel_path = os.path.join(excel_section_dir, f"{policy_id}.xlsx")
-            raw_path = os.path.join(json_section_dir, f"{policy_id}_raw.txt")
+                # Use fallback if missing or invalid
+                if not raw_policy_id:
+                    raw_policy_id = f"subpolicy_{subpolicy_counter}"
 
+                policy_id = raw_policy_id.replace("/", "-").replace("\\", "-").replace(" ", "_")
 
-            with open(json_path, "w", encoding="utf-8") as jf:
-                json.dump(policy_data, jf, indent=2)
+                subpolicy_counter += 1
 
-            pd.DataFrame([policy_data]).to_excel(excel_path, index=False)
+                # === Create section folders ===
+                json_section_dir = os.path.join(output_json_dir, section)
+                excel_section_dir = os.path.join(output_excel_dir, section)
+                os.makedirs(json_section_dir, exist_ok=True)
+                os.makedirs(excel_section_dir, exist_ok=True)
 
-            with open(raw_path, "w", encoding="utf-8") as rf:
-                rf.write(response)
+                # === Output paths ===
+                json_path = os.path.join(json_section_dir, f"{policy_id}.json")
+                excel_path = os.path.join(excel_section_dir, f"{policy_id}.xlsx")
+                raw_path = os.path.join(json_section_dir, f"{policy_id}_raw.txt")
 
-            print(f"✅ Saved: {policy_id}.json + .xlsx")
 
-            # === Append to master + save incrementally ===
-            master_rows.append(policy_data)
-            master_df = pd.DataFrame(master_rows)
-            master_df.to_excel(master_excel_path, index=False)
+                with open(json_path, "w", encoding="utf-8") as jf:
+                    json.dump(policy_data, jf, indent=2)
 
-        except Exception as e:
-            print(f"❌ Failed on {file}: {e}")
+                pd.DataFrame([policy_data]).to_excel(excel_path, index=False)
+
+                with open(raw_path, "w", encoding="utf-8") as rf:
+                    rf.write(response)
 
-print(f"\n✅ Final master Excel saved to: {master_excel_path}")
+                print(f"✅ Saved: {policy_id}.json + .xlsx")
+
+                if corpus is not None:
+                    corpus.add_policy(section, chunk_id, policy_data)
+
+                # === Append to master log ===
+                master.append(policy_data)
+
+            except Exception as e:
+                print(f"❌ Failed on {file}: {e}")
+
+        if corpus is not None:
+            corpus.commit()
+
+    master.close()
+    print(f"\n✅ Final master Excel saved to: {master_excel_path}")
+    if response_cache is not None:
+        print(f"♻️ LLM cache: {response_cache.hits} hits, {response_cache.misses} misses")
+    if corpus is not None:
+        corpus.close()
+        print(f"✅ Corpus store saved to: {corpus_db_path}")
 
 
@@ -1,5 +1,6 @@
 import os
 import json
+import hashlib
 import pandas as pd
 from langchain_ollama import OllamaLLM
 from langchain.prompts import PromptTemplate
@@ -11,12 +12,16 @@ base_dir = "extracted_sections"
 output_json_dir = os.path.join("outputs", "json")
 output_excel_dir = os.path.join("outputs", "excel")
 master_excel_path = os.path.join("outputs", "master_subpolicies.xlsx")
+llm_cache_dir = '.llm_cache'  # responses keyed by model, options, prompt and chunk text; None disables it
+llm_cache_max_bytes = 256 * 1024 * 1024  # least recently used responses are evicted past this size
 
 os.makedirs(output_json_dir, exist_ok=True)
 os.makedirs(output_excel_dir, exist_ok=True)
 
 # === Initialize LLM ===
-llm = OllamaLLM(model="mistral:7b-instruct", options={"num_gpu_layers": 0})
+llm_model = "mistral:7b-instruct"
+llm_options = {"num_gpu_layers": 0}
+llm = OllamaLLM(model=llm_model, options=llm_options)
 
 # === Prompt (strict, unchanged) ===
 prompt_template = PromptTemplate.from_template("""
@@ -66,10 +71,107 @@ Return only the JSON object. Do not include any extra explanation or markdown.
 
 chain = LLMChain(llm=llm, prompt=prompt_template)
 
+# === LLM response cache ===
+class LLMResponseCache:
+    # LLM responses on disk, keyed by a hash of the model, its generation options, the prompt
+    # template and the normalized chunk text, so unchanged chunks skip the model on re-runs.
+    # Least recently used entries are evicted once the cache grows past max_bytes.
+    def __init__(self, cache_dir, model, options, prompt_template, max_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.key_prefix = json.dumps(
+            {"model": model, "options": options, "prompt_template": prompt_template}, sort_keys=True
+        )
+        self.hits = 0
+        self.misses = 0
+        self.recount_every = 100
+        self.saves_since_recount = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = self.disk_bytes()
+
+    def entries(self):
+        return [
+            os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".json")
+        ]
+
+    def entry_stats(self):
+        # (mtime, size, path) of every entry, skipping files another process just evicted
+        stats = []
+        for path in self.entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            stats.append((stat.st_mtime, stat.st_size, path))
+        return stats
+
+    def disk_bytes(self):
+        return sum(size for _, size, _ in self.entry_stats())
+
+    def path(self, text):
+        key = hashlib.sha256(f"{self.key_prefix}\0{text}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, text):
+        path = self.path(text)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                response = json.load(f)["response"]
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)  # marks the entry as recently used
+        except FileNotFoundError:
+            pass  # evicted by another process since it was read
+        self.hits += 1
+        return response
+
+    def entry_size(self, path):
+        # 0 when the entry doesn't exist, including when another process just evicted it
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    def save(self, text, response):
+        path = self.path(text)
+        old_size = self.entry_size(path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"response": response}, f)
+        os.replace(tmp_path, path)
+        self.total_bytes += self.entry_size(path) - old_size
+        self.saves_since_recount += 1
+        # total_bytes only tracks this process's writes; final.py and gpt_full_extra.py can
+        # share cache_dir, so the directory is recounted every recount_every saves and
+        # before anything is evicted
+        if self.total_bytes > self.max_bytes or self.saves_since_recount >= self.recount_every:
+            self.total_bytes = self.disk_bytes()
+            self.saves_since_recount = 0
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Drops the least recently used entries down to 90% of max_bytes, so a full cache
+        # isn't rescanned on every save
+        for _, size, path in sorted(self.entry_stats()):
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # evicted by another process in the meantime
+            self.total_bytes -= size
+
 # === State ===
 subpolicy_counter = 1
 master_rows = []
 last_heading_written = None
+response_cache = (
+    LLMResponseCache(llm_cache_dir, llm_model, llm_options, prompt_template.template, llm_cache_max_bytes)
+    if llm_cache_dir else None
+)
 
 # === Traverse all folders ===
 for section in sorted(os.listdir(base_dir)):
@@ -101,7 +203,11 @@ for section in sorted(os.listdir(base_dir)):
         normalized_text = raw_text.replace("\r\n", "\n").replace("\n\n", "\n")
 
         try:
-            response = chain.invoke({"text": normalized_text})["text"]
+            response = response_cache.load(normalized_text) if response_cache is not None else None
+            if response is None:
+                response = chain.invoke({"text": normalized_text})["text"]
+                if response_cache is not None:
+                    response_cache.save(normalized_text, response)
 
             json_text = response.strip()
             if json_text.startswith("```"):
@@ -184,3 +290,5 @@ for section in sorted(os.listdir(base_dir)):
             print(f"❌ Failed on {file}: {e}")
 
 print(f"\n✅ Final master Excel saved to: {master_excel_path}")
+if response_cache is not None:
+    print(f"♻️ LLM cache: {response_cache.hits} hits, {response_cache.misses} misses")
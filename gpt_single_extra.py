@@ -1,4 +1,5 @@
 import os
+import re
 import json
 import pandas as pd
 from langchain_ollama import OllamaLLM
@@ -75,20 +76,74 @@ normalized_text = raw_text.replace("\r\n", "\n").replace("\n\n", "\n")
 
 # === Chunking ===
 encoding = tiktoken.get_encoding("gpt2")
-tokens = encoding.encode(normalized_text)
-chunk_size = 500
-overlap = 200  # Increased overlap for bullet continuity
-
-chunks = []
-start = 0
-while start < len(tokens):
-    end = min(start + chunk_size, len(tokens))
-    chunk_tokens = tokens[start:end]
-    chunk_text = encoding.decode(chunk_tokens)
-    chunks.append(chunk_text)
-    if end == len(tokens):
-        break
-    start = end - overlap
+chunk_size = 500  # token budget per chunk
+overlap = 50  # only used inside a single unit that is larger than chunk_size
+
+# A unit starts at a section heading or an enhancement "(n)" at the start of a line,
+# allowing for one stray margin glyph (and the "| " extraction leaves before enhancements)
+UNIT_START_RE = re.compile(
+    r"^.?(?:Control|Discussion|Related Controls|Control Enhancements|References):|^.?(?:\|\s*)?\(\d+\)\s",
+    re.MULTILINE,
+)
+
+def count_tokens(text):
+    return len(encoding.encode(text))
+
+def split_structural_units(text):
+    starts = [m.start() for m in UNIT_START_RE.finditer(text) if m.start() > 0]
+    bounds = [0] + starts + [len(text)]
+    return [text[a:b] for a, b in zip(bounds, bounds[1:]) if text[a:b]]
+
+def split_oversized_unit(unit, chunk_size, overlap):
+    # Packs the unit line by line; every piece after the first repeats the last lines of the
+    # previous one (up to `overlap` tokens). Lines that are too long on their own are cut
+    # into token windows.
+    line_limit = chunk_size - overlap
+    lines = []
+    for line in unit.splitlines(keepends=True):
+        line_tokens = encoding.encode(line)
+        for s in range(0, len(line_tokens), line_limit):
+            window = line_tokens[s:s + line_limit]
+            lines.append((line if len(window) == len(line_tokens) else encoding.decode(window), len(window)))
+
+    pieces = []
+    current, current_tokens = [], 0
+    for line, line_count in lines:
+        if current and current_tokens + line_count > chunk_size:
+            pieces.append("".join(l for l, _ in current))
+            carried, carried_tokens = [], 0
+            for l, n in reversed(current):
+                if carried_tokens + n > overlap:
+                    break
+                carried.insert(0, (l, n))
+                carried_tokens += n
+            current, current_tokens = carried, carried_tokens
+        current.append((line, line_count))
+        current_tokens += line_count
+    if current:
+        pieces.append("".join(l for l, _ in current))
+    return pieces
+
+def chunk_by_structure(text, chunk_size, overlap):
+    # Packs whole units into chunks of up to chunk_size tokens (counted per unit)
+    chunks = []
+    current, current_tokens = [], 0
+    for unit in split_structural_units(text):
+        unit_tokens = count_tokens(unit)
+        if current and current_tokens + unit_tokens > chunk_size:
+            chunks.append("".join(current))
+            current, current_tokens = [], 0
+        if unit_tokens > chunk_size:
+            chunks.extend(split_oversized_unit(unit, chunk_size, overlap))
+            continue
+        current.append(unit)
+        current_tokens += unit_tokens
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+chunks = chunk_by_structure(normalized_text, chunk_size, overlap)
+print(f"{len(chunks)} chunks, {sum(count_tokens(c) for c in chunks)} tokens for a {count_tokens(normalized_text)}-token text")
 
 # Save chunks for debug
 for i, chunk in enumerate(chunks, 1):
@@ -128,7 +183,26 @@ for i, chunk in enumerate(chunks, 1):
         print(f"Failed on chunk {i}: {e}")
 
 # === Merge Function ===
+min_overlap_chars = 20  # shorter suffix/prefix matches are treated as coincidence
+
+def overlap_length(previous, following):
+    # Length of the longest suffix of `previous` that is also a prefix of `following`:
+    # the KMP prefix function of following + "\0" + the tail of previous, in linear time
+    if not following:
+        return 0
+    combined = following + "\0" + previous[-len(following):]
+    prefix = [0] * len(combined)
+    for i in range(1, len(combined)):
+        k = prefix[i - 1]
+        while k and combined[i] != combined[k]:
+            k = prefix[k - 1]
+        if combined[i] == combined[k]:
+            k += 1
+        prefix[i] = k
+    return prefix[-1]
+
 def merge_sections(results):
+    # Returns the merged fields and how many characters of chunk overlap were dropped
     merged = {
         "PolicyId": None,
         "PolicyName": None,
@@ -138,6 +212,7 @@ def merge_sections(results):
         "ControlEnhancements": [],
         "References": []
     }
+    deduplicated_chars = 0
 
     for r in results:
         if merged["PolicyId"] is None and r.get("PolicyId") and r["PolicyId"] != "None":
@@ -150,15 +225,23 @@ def merge_sections(results):
             if val:
                 cleaned = " ".join(str(x).strip() for x in val if str(x).strip()) if isinstance(val, list) else str(val).strip()
                 if cleaned:
+                    # Text repeated from the previous chunk's overlap is spliced, not appended again
+                    if merged[key]:
+                        shared = overlap_length(merged[key][-1], cleaned)
+                        if shared >= min_overlap_chars:
+                            merged[key][-1] += cleaned[shared:]
+                            deduplicated_chars += shared
+                            continue
                     merged[key].append(cleaned)
 
     for key in merged:
         if isinstance(merged[key], list):
             merged[key] = "\n".join(merged[key]) if merged[key] else "None"
 
-    return merged
+    return merged, deduplicated_chars
 
-policy_data = merge_sections(partial_results)
+policy_data, deduplicated_chars = merge_sections(partial_results)
+print(f"Merged {len(partial_results)} chunk results, {deduplicated_chars} overlapping characters deduplicated")
 
 # === Save Outputs ===
 with open(output_json_path, "w", encoding="utf-8") as jf: